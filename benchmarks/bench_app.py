@@ -0,0 +1,405 @@
+"""End-to-end load test: chat fan-out plus page, vote and login traffic.
+
+Starts the app under uvicorn on a background thread against a scratch
+SQLite database, seeds users and polls, then for DURATION seconds drives
+CLIENTS WebSocket clients spread over CHANNELS channels through
+/ws/{channel}, each sending RATE messages per second, alongside a steady
+stream of GET /c/{channel}, POST /p/{channel}/vote/{poll_id} and
+POST /auth/login requests. Reports:
+
+- throughput: messages sent, deliveries and HTTP requests per second
+- end-to-end delivery latency (send -> every receiver), p50/p99
+- HTTP latency per endpoint, p50/p99
+- database queries per request, measured one request at a time before
+  the load starts
+
+Results are compared with the saved baseline for the same settings and
+anything worse than --tolerance is flagged as a regression (exit code 1).
+The load generator shares the machine (and the GIL) with the server, so
+compare runs from the same machine only.
+
+    python -m benchmarks.bench_app [--clients 200] [--channels 10] [--duration 20]
+    python -m benchmarks.bench_app --save-baseline
+
+Needs the ``websockets`` and ``httpx`` packages (uvicorn[standard] brings
+the first).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baselines", "bench_app.json")
+PASSWORD = "bench-password"
+POLL_OPTIONS = 3
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def use_scratch_database(url):
+    """Point the app's engine and sessions at ``url``; call before importing main"""
+    import database
+    from sqlalchemy import create_engine
+
+    engine = create_engine(url, connect_args={"check_same_thread": False})
+    database.engine = engine
+    database.SessionLocal.configure(bind=engine)
+    return engine
+
+
+class QueryCounter:
+    """Counts statements sent to the database from any thread, over one or more engines"""
+
+    def __init__(self, *engines):
+        from sqlalchemy import event
+
+        self._counter = itertools.count()
+        self.value = 0
+        for engine in set(engines):
+            event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        self.value = next(self._counter) + 1
+
+
+class ServerThread(threading.Thread):
+    def __init__(self, app):
+        import uvicorn
+
+        super().__init__(daemon=True)
+        self.server = uvicorn.Server(uvicorn.Config(
+            app, host="127.0.0.1", port=0, log_level="warning", lifespan="on"
+        ))
+
+    def run(self):
+        self.server.run()
+
+    def start_and_wait(self) -> int:
+        self.start()
+        while not self.server.started:
+            if not self.is_alive():
+                raise RuntimeError("Server failed to start")
+            time.sleep(0.05)
+        return self.server.servers[0].sockets[0].getsockname()[1]
+
+    def stop(self):
+        self.server.should_exit = True
+        self.join()
+
+
+def seed(clients, channels):
+    """Users with known passwords and one poll per channel; returns tokens and polls"""
+    import jwt
+    from config import SECRET_KEY
+    from database import SessionLocal
+    from models import User, Poll, PollOption
+    from services.password_hasher import pwd_context
+
+    hashed = pwd_context.hash(PASSWORD)
+    db = SessionLocal()
+    try:
+        users = [User(username=f"bench{i}", password=hashed) for i in range(clients)]
+        db.add_all(users)
+        db.flush()
+        polls = {}
+        for c in range(channels):
+            channel = f"bench-{c}"
+            poll = Poll(title=f"Poll {c}", channel=channel, creator_id=users[0].id)
+            db.add(poll)
+            db.flush()
+            options = [PollOption(text=f"Option {o}", poll_id=poll.id) for o in range(POLL_OPTIONS)]
+            db.add_all(options)
+            db.flush()
+            polls[channel] = (poll.id, [option.id for option in options])
+        db.commit()
+        # Same token format as /auth/login, without paying for a bcrypt per client
+        tokens = [jwt.encode({"username": user.username}, SECRET_KEY, algorithm="HS256") for user in users]
+        return tokens, polls
+    finally:
+        db.close()
+
+
+class Load:
+    def __init__(self, base_url, tokens, polls, args):
+        self.http_url = base_url
+        self.ws_url = base_url.replace("http://", "ws://")
+        self.tokens = tokens
+        self.polls = polls
+        self.channels = sorted(polls)
+        self.args = args
+        self.sent = 0
+        self.latencies = []
+        self.http = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.stopping = False
+
+    def client(self, token=None):
+        import httpx
+
+        cookies = {"session_token": token} if token else None
+        return httpx.AsyncClient(base_url=self.http_url, cookies=cookies, timeout=30)
+
+    async def page(self, http):
+        return await http.get(f"/c/{random.choice(self.channels)}")
+
+    async def vote(self, http):
+        channel = random.choice(self.channels)
+        poll_id, options = self.polls[channel]
+        return await http.post(f"/p/{channel}/vote/{poll_id}", data={"option_id": random.choice(options)})
+
+    async def login(self, http):
+        user = random.randrange(len(self.tokens))
+        return await http.post(
+            "/auth/login", data={"username": f"bench{user}", "password": PASSWORD}, follow_redirects=False
+        )
+
+    async def ws_client(self, index, ready, start):
+        from websockets.asyncio.client import connect
+
+        channel = self.channels[index % len(self.channels)]
+        headers = [("Cookie", f"session_token={self.tokens[index]}")]
+        try:
+            ws = await connect(f"{self.ws_url}/ws/{channel}", additional_headers=headers, max_queue=None)
+        except Exception:
+            self.errors["connect"] += 1
+            ready.release()
+            return
+        async with ws:
+            receiver = asyncio.create_task(self._receive(ws))
+            ready.release()
+            await start.wait()
+            interval = 1 / self.args.rate
+            # Spread the first sends so clients do not fire in lockstep
+            await asyncio.sleep(random.random() * interval)
+            while not self.stopping:
+                # The content is the send time, so every receiver can compute latency
+                await ws.send(json.dumps({"content": repr(time.perf_counter())}))
+                self.sent += 1
+                await asyncio.sleep(interval)
+            await asyncio.sleep(self.args.drain)
+            receiver.cancel()
+
+    async def _receive(self, ws):
+        async for frame in ws:
+            data = json.loads(frame)
+            if "content" in data and data.get("type") is None:
+                try:
+                    self.latencies.append(time.perf_counter() - float(data["content"]))
+                except ValueError:
+                    pass
+
+    async def http_stream(self, kind, rate):
+        if rate <= 0:
+            return
+        slots = asyncio.Semaphore(self.args.http_concurrency)
+        request = getattr(self, kind)
+        tasks = []
+
+        async def one(http):
+            async with slots:
+                started = time.perf_counter()
+                try:
+                    response = await request(http)
+                    if response.status_code >= 400:
+                        self.errors[kind] += 1
+                except Exception:
+                    self.errors[kind] += 1
+                self.http[kind].append(time.perf_counter() - started)
+
+        async with self.client(random.choice(self.tokens)) as http:
+            while not self.stopping:
+                tasks.append(asyncio.create_task(one(http)))
+                await asyncio.sleep(1 / rate)
+            await asyncio.gather(*tasks)
+
+    async def run(self):
+        ready = asyncio.Semaphore(0)
+        start = asyncio.Event()
+        clients = [asyncio.create_task(self.ws_client(i, ready, start)) for i in range(self.args.clients)]
+        for _ in clients:
+            await ready.acquire()
+        start.set()
+        started = time.perf_counter()
+        streams = [
+            asyncio.create_task(self.http_stream("page", self.args.page_rate)),
+            asyncio.create_task(self.http_stream("vote", self.args.vote_rate)),
+            asyncio.create_task(self.http_stream("login", self.args.login_rate)),
+        ]
+        await asyncio.sleep(self.args.duration)
+        self.stopping = True
+        elapsed = time.perf_counter() - started
+        await asyncio.gather(*streams, *clients)
+        return elapsed
+
+
+async def queries_per_request(load, counter, samples):
+    """Statements per request, issued one at a time with nothing else running"""
+    from services.message_writer import MESSAGE_BATCH_WINDOW
+    from websockets.asyncio.client import connect
+
+    results = {}
+    async with load.client(load.tokens[0]) as http:
+        for kind in ("page", "vote", "login"):
+            await getattr(load, kind)(http)  # warm caches the way steady traffic would
+            before = counter.value
+            for _ in range(samples):
+                await getattr(load, kind)(http)
+            results[kind] = (counter.value - before) / samples
+
+    headers = [("Cookie", f"session_token={load.tokens[0]}")]
+    async with connect(f"{load.ws_url}/ws/{load.channels[0]}", additional_headers=headers) as ws:
+        before = counter.value
+        for i in range(samples):
+            await ws.send(json.dumps({"content": "calibration"}))
+            while "content" not in json.loads(await ws.recv()):
+                pass
+            # Let each message's group commit happen inside the measurement
+            await asyncio.sleep(MESSAGE_BATCH_WINDOW * 3)
+        results["message"] = (counter.value - before) / samples
+    return results
+
+
+def summarize(load, elapsed, queries):
+    deliveries = len(load.latencies)
+    results = {
+        "connect_errors": load.errors["connect"],
+        "messages_per_s": load.sent / elapsed,
+        "deliveries_per_s": deliveries / elapsed,
+        "delivery_p50_ms": percentile(load.latencies, 50) * 1000,
+        "delivery_p99_ms": percentile(load.latencies, 99) * 1000,
+    }
+    for kind, latencies in sorted(load.http.items()):
+        results[f"{kind}_per_s"] = len(latencies) / elapsed
+        results[f"{kind}_p50_ms"] = percentile(latencies, 50) * 1000
+        results[f"{kind}_p99_ms"] = percentile(latencies, 99) * 1000
+        results[f"{kind}_errors"] = load.errors[kind]
+    for kind, value in sorted(queries.items()):
+        results[f"{kind}_queries"] = value
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """Metrics worse than baseline by more than ``tolerance`` (a fraction)"""
+    worse = []
+    for name, value in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if name.endswith("_per_s"):
+            bad = value < old * (1 - tolerance)
+        elif name.endswith("_queries"):
+            # Query counts are deterministic; any extra query is a regression
+            bad = value > old + 0.5
+        else:
+            bad = value > old * (1 + tolerance) and value - old > 1
+        if bad:
+            worse.append(name)
+    return worse
+
+
+def settings_key(args):
+    return (f"clients={args.clients} channels={args.channels} duration={args.duration} "
+            f"rate={args.rate} page={args.page_rate} vote={args.vote_rate} login={args.login_rate}")
+
+
+async def bench(args, base_url, tokens, polls, counter):
+    load = Load(base_url, tokens, polls, args)
+    queries = await queries_per_request(load, counter, args.samples)
+    elapsed = await load.run()
+    return summarize(load, elapsed, queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second per client")
+    parser.add_argument("--page-rate", type=float, default=20, help="GET /c/{channel} per second")
+    parser.add_argument("--vote-rate", type=float, default=10, help="poll votes per second")
+    parser.add_argument("--login-rate", type=float, default=2, help="logins per second")
+    parser.add_argument("--http-concurrency", type=int, default=50)
+    parser.add_argument("--drain", type=float, default=1.0, help="seconds to wait for in-flight deliveries")
+    parser.add_argument("--samples", type=int, default=20, help="requests per kind when counting queries")
+    parser.add_argument("--database-url", help="defaults to a throwaway SQLite file")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    scratch = None
+    if args.database_url is None:
+        scratch = os.path.join(tempfile.mkdtemp(prefix="bench_app_"), "bench.db")
+        args.database_url = f"sqlite:///{scratch}"
+    engine = use_scratch_database(args.database_url)
+    import main as app_module
+    from services.db_executor import read_engine
+    from services.migrations import run_migrations
+
+    # The app migrates on startup, but the seed data goes in first
+    run_migrations(engine)
+
+    # Reads are routed to their own pool; count both
+    counter = QueryCounter(engine, read_engine)
+    tokens, polls = seed(args.clients, args.channels)
+    server = ServerThread(app_module.app)
+    port = server.start_and_wait()
+    try:
+        results = asyncio.run(bench(args, f"http://127.0.0.1:{port}", tokens, polls, counter))
+    finally:
+        server.stop()
+        engine.dispose()
+        read_engine.dispose()
+        if scratch:
+            os.remove(scratch)
+
+    key = settings_key(args)
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    baseline = baselines.get(key, {}).get("results", {})
+
+    worse = regressions(results, baseline, args.tolerance) if baseline else []
+    print(f"{key}")
+    print(f"{'metric':>22} {'current':>10} {'baseline':>10}")
+    for name, value in results.items():
+        old = baseline.get(name)
+        old_text = f"{old:10.2f}" if old is not None else f"{'-':>10}"
+        flag = "  REGRESSION" if name in worse else ""
+        print(f"{name:>22} {value:10.2f} {old_text}{flag}")
+
+    if args.save_baseline:
+        baselines[key] = {
+            "results": results,
+            "machine": f"{platform.system()} {platform.machine()}, {os.cpu_count()} CPUs, "
+                       f"Python {platform.python_version()}",
+            "recorded": time.strftime("%Y-%m-%d"),
+        }
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.baseline}")
+    elif not baseline:
+        print("No baseline for these settings; run with --save-baseline to record one")
+    elif worse:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
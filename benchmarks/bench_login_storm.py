@@ -0,0 +1,96 @@
+"""Broadcast latency in a busy room while a burst of logins hashes passwords.
+
+Runs entirely in process: a ConnectionManager room full of in-memory
+sockets receives a broadcast every few milliseconds while LOGINS bcrypt
+verifications run, first inline on the event loop (the old behaviour)
+and then through services.password_hasher. Reports delivery latency
+percentiles for both.
+
+    python -m benchmarks.bench_login_storm [--sockets 500] [--logins 50]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from services.cm import ConnectionManager
+from services.password_hasher import PasswordHasher, pwd_context
+
+
+class FakeSocket:
+    def __init__(self, latencies):
+        self.latencies = latencies
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, frame):
+        self.latencies.append(time.perf_counter() - json.loads(frame)["sent"])
+
+    async def close(self, code=1000):
+        pass
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def run(mode, sockets, logins, interval):
+    latencies = []
+    manager = ConnectionManager(max_queue=10_000)
+    await manager.start()
+    for _ in range(sockets):
+        await manager.connect(FakeSocket(latencies), "bench")
+
+    hasher = PasswordHasher()
+    hashed = pwd_context.hash("correct horse")
+    stop = asyncio.Event()
+
+    async def ticker():
+        while not stop.is_set():
+            # The frame carries its send time, so receivers can compute latency
+            await manager.broadcast("bench", {"sent": time.perf_counter()})
+            await asyncio.sleep(interval)
+
+    async def login():
+        if mode == "inline":
+            pwd_context.verify("correct horse", hashed)
+            await asyncio.sleep(0)
+        else:
+            await hasher.verify("correct horse", hashed)
+
+    tick = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await tick
+    await asyncio.sleep(interval * 5)
+    hasher.shutdown()
+    await manager.stop()
+
+    print(
+        f"{mode:>7}: {logins} logins in {elapsed:.2f}s | broadcast delivery "
+        f"p50={percentile(latencies, 50) * 1000:.1f}ms "
+        f"p99={percentile(latencies, 99) * 1000:.1f}ms "
+        f"max={max(latencies, default=0) * 1000:.1f}ms "
+        f"mean={statistics.fmean(latencies) * 1000 if latencies else 0:.1f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sockets", type=int, default=500)
+    parser.add_argument("--logins", type=int, default=50)
+    parser.add_argument("--interval", type=float, default=0.01, help="seconds between broadcasts")
+    args = parser.parse_args()
+    for mode in ("inline", "pool"):
+        asyncio.run(run(mode, args.sockets, args.logins, args.interval))
+
+
+if __name__ == "__main__":
+    main()
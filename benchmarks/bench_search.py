@@ -0,0 +1,145 @@
+"""Search latency over a synthetic chat corpus.
+
+Builds a throwaway SQLite database with the app's migrations, loads
+MESSAGES messages through the FTS insert triggers (so the load time is
+also the cost of incremental indexing), then times services.search
+queries for rare, common and prefix terms, with and without channel and
+author filters, and for a second page fetched with the cursor. Loading
+the default million messages takes several minutes.
+
+    python -m benchmarks.bench_search [--messages 1000000] [--queries 200]
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from services.migrations import run_migrations
+from services.search import SearchIndex
+
+CHANNELS = 50
+USERS = 2000
+VOCABULARY = 20000
+WORDS_PER_MESSAGE = (3, 20)
+INSERT_BATCH = 10000
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def make_vocabulary(rng):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < VOCABULARY:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 9))))
+    # Zipf-like frequencies: the n-th word is used about 1/n as often as the first
+    words = sorted(words)
+    weights = [1 / (n + 1) for n in range(len(words))]
+    return words, weights
+
+
+def load_corpus(engine, messages, rng, words, weights):
+    started = time.perf_counter()
+    base_time = datetime(2024, 1, 1)
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO users (id, username, password) VALUES (:id, :name, 'x')"), [
+            {"id": i, "name": f"user{i}"} for i in range(1, USERS + 1)
+        ])
+        for start in range(0, messages, INSERT_BATCH):
+            rows = []
+            for i in range(start, min(start + INSERT_BATCH, messages)):
+                rows.append({
+                    "id": i + 1,
+                    "content": " ".join(rng.choices(words, weights, k=rng.randint(*WORDS_PER_MESSAGE))),
+                    "timestamp": base_time + timedelta(seconds=i),
+                    "channel": f"channel{rng.randrange(CHANNELS)}",
+                    "user_id": rng.randint(1, USERS),
+                    "seq": i + 1,
+                })
+            connection.execute(text(
+                "INSERT INTO messages (id, content, timestamp, channel, user_id, seq) "
+                "VALUES (:id, :content, :timestamp, :channel, :user_id, :seq)"
+            ), rows)
+    return time.perf_counter() - started
+
+
+def time_queries(session_factory, index, cases, queries):
+    for label, make_args in cases:
+        latencies = []
+        hits = 0
+        for _ in range(queries):
+            args = make_args()
+            db = session_factory()
+            try:
+                started = time.perf_counter()
+                results, _ = index.search_messages(db, **args)
+                latencies.append(time.perf_counter() - started)
+                hits += len(results)
+            finally:
+                db.close()
+        print(
+            f"{label:>24}: p50={percentile(latencies, 50) * 1000:.2f}ms "
+            f"p99={percentile(latencies, 99) * 1000:.2f}ms "
+            f"mean={statistics.fmean(latencies) * 1000:.2f}ms "
+            f"hits/query={hits / queries:.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    words, weights = make_vocabulary(rng)
+    path = os.path.join(tempfile.mkdtemp(prefix="bench_search_"), "search.db")
+    engine = create_engine(f"sqlite:///{path}")
+    run_migrations(engine)
+    index = SearchIndex()
+    if not index.detect(engine):
+        print("SQLite here has no FTS5; timing the LIKE fallback instead")
+
+    elapsed = load_corpus(engine, args.messages, rng, words, weights)
+    print(f"Indexed {args.messages} messages in {elapsed:.1f}s "
+          f"({args.messages / elapsed:.0f} inserts/s), database {os.path.getsize(path) / 2**20:.0f} MiB")
+
+    session_factory = sessionmaker(bind=engine)
+    common = words[:20]
+    rare = words[VOCABULARY // 2:]
+
+    def second_page(term):
+        db = session_factory()
+        try:
+            _, cursor = index.search_messages(db, term)
+        finally:
+            db.close()
+        return {"query": term, "cursor": cursor}
+
+    cases = [
+        ("rare term", lambda: {"query": rng.choice(rare)}),
+        ("common term", lambda: {"query": rng.choice(common)}),
+        ("two terms", lambda: {"query": f"{rng.choice(common)} {rng.choice(words[:500])}"}),
+        ("prefix", lambda: {"query": rng.choice(words[:2000])[:3]}),
+        ("common + channel", lambda: {"query": rng.choice(common), "channel": f"channel{rng.randrange(CHANNELS)}"}),
+        ("common + author", lambda: {"query": rng.choice(common), "author": f"user{rng.randint(1, USERS)}"}),
+        ("common, second page", lambda: second_page(rng.choice(common))),
+    ]
+    time_queries(session_factory, index, cases, args.queries)
+    engine.dispose()
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,92 @@
 from fastapi import (
     FastAPI, WebSocket, WebSocketDisconnect, Depends, Cookie, Request
 )
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, JSONResponse, PlainTextResponse
+from contextlib import asynccontextmanager
+import traceback
 from sqlalchemy.orm import Session
 
-from passlib.context import CryptContext
-import json
-from typing import Optional
+from typing import List, Optional
 
 from config import templates
-from database import engine, get_db
-from models import User, Message, Poll, Base
+from database import engine
+from models import User, Message
 from dtos import *
-from services.gcu import get_current_user
+from services.gcu import get_current_user, share_invalidations
 from services.cm import ConnectionManager
+from services.history import fetch_history, fetch_since, HISTORY_PAGE_SIZE, MAX_REPLAY_MESSAGES
+from services.poll_service import format_polls
+from services.message_writer import MessageWriter, ChannelSequences, DURABILITY_SYNC, valid_parent_id
+from services.password_hasher import pwd_context, password_hasher
+from services import db_executor
+from services.db_executor import run_db, run_in_session, run_in_read_session, get_db, get_read_db, session_scope
+from services.channel_directory import channel_directory, backfill_channels
+from services.presence import PresenceTracker
+from services.chat_protocol import negotiate, receive_frame, epoch_ms
+from services.message_cache import history_entry
+from services.search import search_index
+from services.migrations import run_migrations
+from services.threads import fetch_thread, THREAD_DEPTH, THREAD_PAGE_SIZE
+from services.rate_limit import IngestLimiter, FRAME_TOO_LARGE, MAX_REJECTED_FRAMES
+from services import metrics
 
 
-app = FastAPI()
+manager = ConnectionManager()
 
+presence = PresenceTracker(manager)
 
-Base.metadata.create_all(bind=engine)
+# Sequence numbers go through the broadcast backend so every worker shares them
+message_writer = MessageWriter(sequences=ChannelSequences(manager.backend))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+ingest_limiter = IngestLimiter()
 
 
-manager = ConnectionManager()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Schema first; workers starting together take turns (services/migrations.py)
+    await run_db(run_migrations, engine)
+    await run_db(search_index.detect, engine)
+    await manager.start()
+    await share_invalidations(manager)
+    await run_in_session(backfill_channels)
+    await message_writer.start()
+    await presence.start()
+    yield
+    await presence.stop()
+    await message_writer.stop()
+    await manager.stop()
+    password_hasher.shutdown()
+    db_executor.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.instrument_engine(engine)
+metrics.instrument_engine(db_executor.read_engine)
+
+# Read from the live objects when /metrics is scraped, so they cost nothing in between
+metrics.GaugeFunction(
+    "chat_websockets_active", "Open WebSocket connections per channel", ("channel",),
+    lambda: [((channel,), len(room)) for channel, room in manager.rooms.items()]
+)
+metrics.GaugeFunction(
+    "chat_send_queue_frames", "Frames waiting in a channel's send queues, all sockets together", ("channel",),
+    lambda: [((channel,), sum(len(c.queue) for c in room.values())) for channel, room in manager.rooms.items()]
+)
+metrics.GaugeFunction(
+    "chat_send_queue_max_frames", "Deepest send queue of any socket in the channel", ("channel",),
+    lambda: [((channel,), max((len(c.queue) for c in room.values()), default=0))
+             for channel, room in manager.rooms.items()]
+)
+metrics.GaugeFunction(
+    "chat_write_behind_pending", "Chat messages accepted but not committed yet",
+    collect=lambda: [((), len(message_writer.pending))]
+)
+metrics.GaugeFunction(
+    "password_hash_pending", "Password hashes waiting for a bcrypt worker",
+    collect=lambda: [((), password_hasher.pending)]
+)
+
 
 
 @app.get("/login")
@@ -61,18 +123,21 @@ async def logout():
     return response
 
 
-@app.get("/")
-async def root(request: Request, current_user: Optional[User] = Depends(get_current_user), db: Session = Depends(get_db)):
-    message_channels = db.query(Message.channel).distinct().limit(10).all()
-
-    all_channels = set([channel[0] for channel in message_channels])
+async def channel_directory_page(db: Session, limit: Optional[int] = None) -> List[dict]:
+    channel_stats = await run_db(channel_directory.list_channels, db, limit=limit)
+    for channel in channel_stats:
+        channel["online_count"] = presence.online_count(channel["name"])
+    return channel_stats
 
-    channels = sorted(list(all_channels))
+@app.get("/")
+async def root(request: Request, current_user: Optional[User] = Depends(get_current_user), db: Session = Depends(get_read_db)):
+    channel_stats = await channel_directory_page(db, limit=10)
 
     return templates.TemplateResponse("index.html", {
         "request": request,
         "user": current_user,
-        "channels": channels
+        "channels": [channel["name"] for channel in channel_stats],
+        "channel_stats": channel_stats
     })
 
 @app.get("/c/{channel_name}")
@@ -80,59 +145,163 @@ async def channel_chat(
     request: Request, 
     channel_name: str,
     current_user: Optional[User] = Depends(get_current_user), 
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     if not current_user:
         return RedirectResponse(url="/login")
         
-    messages = db.query(Message).join(User).filter(
-        Message.channel == channel_name
-    ).order_by(Message.timestamp).all()
-    
-    formatted_messages = []
-    for msg in messages:
-        message_data = {
-            "id": msg.id,
-            "content": msg.content,
-            "username": msg.user.username,
-            "timestamp": msg.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-            "is_own": msg.user.username == current_user.username,
-        }
-        
-        if msg.parent_message_id:
-            parent = db.query(Message).join(User).filter(Message.id == msg.parent_message_id).first()
-            if parent:
-                message_data["parent_message"] = {
-                    "id": parent.id,
-                    "content": parent.content,
-                    "username": parent.user.username
-                }
-        
-        formatted_messages.append(message_data)
+    # Cached messages are shared, so is_own goes on per-viewer copies
+    cached_messages, next_before = await recent_channel_messages(channel_name)
+    formatted_messages = [
+        dict(message_data, is_own=message_data["username"] == current_user.username)
+        for message_data in cached_messages
+    ]
     
     # Get channel polls
-    polls = db.query(Poll).filter(Poll.channel == channel_name).all()
-    formatted_polls = [{
-        "id": poll.id,
-        "title": poll.title,
-        "description": poll.description,
-        "created_at": poll.created_at.strftime("%Y-%m-%d %H:%M:%S"),
-        "ends_at": poll.ends_at.strftime("%Y-%m-%d %H:%M:%S") if poll.ends_at else None,
-        "is_active": poll.is_active,
-        "creator_username": poll.creator.username,
-        "options": [{"id": opt.id, "text": opt.text, "votes_count": opt.votes_count} for opt in poll.options],
-        "total_votes": poll.total_votes,
-        "user_vote": next((vote.option_id for vote in current_user.poll_votes if vote.option.poll_id == poll.id), None)
-    } for poll in polls]
+    formatted_polls = await run_db(
+        format_polls, db, channel_name, current_user, date_format="%Y-%m-%d %H:%M:%S"
+    )
     
     return templates.TemplateResponse("channel.html", {
         "request": request,
         "user": current_user,
         "messages": formatted_messages,
+        "history_cursor": next_before,
         "channel_name": channel_name,
         "polls": formatted_polls
     })
 
+@app.get("/c/{channel_name}/history")
+async def channel_history(
+    channel_name: str,
+    before: Optional[int] = None,
+    limit: int = HISTORY_PAGE_SIZE,
+    current_user: Optional[User] = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    if not current_user:
+        return JSONResponse(status_code=401, content={"detail": "Unauthorized"})
+
+    messages, next_before = await run_db(
+        fetch_history, db, channel_name, before_seq=before, limit=limit
+    )
+    for message_data in messages:
+        message_data["is_own"] = message_data["username"] == current_user.username
+
+    return {"messages": messages, "next_before": next_before}
+
+@app.get("/c/{channel_name}/thread/{message_id}")
+async def channel_thread(
+    channel_name: str,
+    message_id: int,
+    depth: int = THREAD_DEPTH,
+    limit: int = THREAD_PAGE_SIZE,
+    current_user: Optional[User] = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    if not current_user:
+        return JSONResponse(status_code=401, content={"detail": "Unauthorized"})
+
+    messages, has_more = await run_db(
+        fetch_thread, db, channel_name, message_id, depth=depth, limit=limit
+    )
+    if messages is None:
+        return JSONResponse(status_code=404, content={"detail": "Message not found"})
+    for message_data in messages:
+        message_data["is_own"] = message_data["username"] == current_user.username
+
+    return {"messages": messages, "has_more": has_more}
+
+def lookup_parent_message(db: Session, parent_message_id: int) -> Optional[dict]:
+    # The parent may still be waiting in the write-behind queue
+    pending = message_writer.pending.get(parent_message_id)
+    if pending:
+        parent_user = db.query(User.username).filter(User.id == pending['user_id']).first()
+        return {
+            'id': pending['id'],
+            'content': pending['content'],
+            'username': parent_user.username if parent_user else None
+        }
+    parent_message = db.query(Message).join(User).filter(Message.id == parent_message_id).first()
+    if parent_message:
+        return {
+            'id': parent_message.id,
+            'content': parent_message.content,
+            'username': parent_message.user.username
+        }
+    return None
+
+def pending_message_events(db: Session, rows: List[dict]) -> List[dict]:
+    """Message events for rows still waiting in the write-behind queue"""
+    usernames = dict(db.query(User.id, User.username).filter(
+        User.id.in_({row['user_id'] for row in rows})
+    ))
+    return [{
+        'type': 'message',
+        'id': row['id'],
+        'seq': row['seq'],
+        'content': row['content'],
+        'username': usernames.get(row['user_id']),
+        'ts': epoch_ms(row['timestamp']),
+        'parent_message_id': row['parent_message_id'],
+        'parent_message': lookup_parent_message(db, row['parent_message_id'])
+        if row['parent_message_id'] else None
+    } for row in rows]
+
+def load_missed_messages(db: Session, channel_name: str, last_seq: int) -> Optional[List[dict]]:
+    """Message events after ``last_seq`` from the database, or None if the gap is too long to replay"""
+    events = fetch_since(db, channel_name, last_seq)
+    if len(events) >= MAX_REPLAY_MESSAGES:
+        return None
+
+    # The newest messages may still be waiting in the write-behind queue
+    stored = {event['seq'] for event in events}
+    pending = [
+        row for row in list(message_writer.pending.values())
+        if row['channel'] == channel_name and row['seq'] > last_seq and row['seq'] not in stored
+    ]
+    if pending:
+        events.extend(pending_message_events(db, pending))
+        events.sort(key=lambda event: event['seq'])
+    return events
+
+def load_recent_messages(db: Session, channel_name: str):
+    """A channel's first history page, including messages not committed yet"""
+    # Taken before the read: a row that leaves the queue meanwhile is committed by then
+    pending = [row for row in list(message_writer.pending.values()) if row['channel'] == channel_name]
+    messages, next_before = fetch_history(db, channel_name, limit=manager.recent_messages.page_size)
+    unstored = [history_entry(event) for event in pending_message_events(db, pending)] if pending else []
+    return messages, next_before, unstored
+
+async def recent_channel_messages(channel_name: str):
+    """The channel page's messages, from the hot-channel cache when possible.
+
+    The returned dicts are shared between viewers; copy before changing them.
+    """
+    recent_messages = manager.recent_messages
+    cached = recent_messages.get(channel_name)
+    if cached is not None:
+        return cached
+    recent_messages.begin_load(channel_name)
+    try:
+        messages, next_before, unstored = await run_in_read_session(load_recent_messages, channel_name)
+    except Exception:
+        recent_messages.abort_load(channel_name)
+        raise
+    return recent_messages.finish_load(channel_name, messages, next_before, unstored)
+
+async def resume_session(connection, channel_name: str, last_seq: int):
+    """Replay what a reconnecting client missed, then let live messages through"""
+    # Read synchronously right after joining: everything in the ring predates
+    # the frames held on the connection, anything later is held there
+    events = manager.replay_buffer.since(channel_name, last_seq)
+    if events is None:
+        events = await run_in_session(load_missed_messages, channel_name, last_seq)
+    if events is None:
+        # Too far behind; the client reloads the channel page instead
+        events = [{'type': 'resync', 'last_seq': last_seq}]
+    manager.replay(connection, events)
+
 @app.websocket("/ws/{channel_name}")
 async def websocket_endpoint(
     websocket: WebSocket, 
@@ -142,75 +311,157 @@ async def websocket_endpoint(
     if not session_token:
         await websocket.close(code=1008)
         return
-    db = next(get_db())
     try:
-        current_user = await get_current_user(session_token=session_token, db=db)
+        # Only the handshake needs a session, and it holds no connection; later lookups use short-lived ones
+        with session_scope() as db:
+            current_user = await get_current_user(session_token=session_token, db=db)
+            user_id = current_user.id if current_user else None
+            username = current_user.username if current_user else None
         if not current_user:
             await websocket.close(code=1008)
             return
             
-        await manager.connect(websocket)
+        # A reconnecting client sends the last sequence number it saw
+        try:
+            last_seq = int(websocket.query_params['last_seq'])
+        except (KeyError, ValueError):
+            last_seq = None
+
+        codec = negotiate(websocket)
+        connection = await manager.connect(websocket, channel_name, codec, hold=last_seq is not None)
+        presence.join(channel_name, user_id, username)
 
         try:
+            if last_seq is not None:
+                await resume_session(connection, channel_name, last_seq)
+
+            # Refused frames in a row; a client that keeps flooding is closed
+            rejected = 0
             while True:
-                data = await websocket.receive_text()
-                message_data = json.loads(data)
+                frame = await receive_frame(websocket)
+
+                # Flood control runs before the frame is even decoded
+                reason, retry_after = ingest_limiter.check(user_id, channel_name, len(frame))
+                if reason is None:
+                    try:
+                        message_data = codec.decode(frame)
+                        if message_data.get('type') != 'typing':
+                            if not isinstance(message_data.get('content'), str):
+                                raise ValueError("Message without content")
+                            if not valid_parent_id(message_data.get('parent_message_id')):
+                                raise ValueError("Invalid parent_message_id")
+                    except ValueError:
+                        reason = 'invalid_frame'
+                if reason is not None:
+                    metrics.WEBSOCKET_FRAMES_REJECTED.labels(reason).inc()
+                    if reason == FRAME_TOO_LARGE:
+                        await websocket.close(code=1009)
+                        break
+                    rejected += 1
+                    if rejected >= MAX_REJECTED_FRAMES:
+                        metrics.WEBSOCKET_FLOOD_CLOSES.inc()
+                        await websocket.close(code=1008)
+                        break
+                    if rejected == 1:
+                        # One notice per run of refusals, so the reject path stays cheap
+                        connection.enqueue(codec.encode({
+                            'type': 'error',
+                            'code': reason,
+                            'detail': 'Message not sent',
+                            'retry_after_ms': int(retry_after * 1000),
+                        }))
+                    continue
+                rejected = 0
+
+                # Typing indicators are rate-limited and never reach the database
+                if message_data.get('type') == 'typing':
+                    presence.typing(channel_name, user_id)
+                    continue
+                
+                metrics.WEBSOCKET_MESSAGES_RECEIVED.inc()
+                # Get parent message info if this is a reply; done before the
+                # seq is assigned so nothing slow sits between it and the broadcast
+                parent_message_info = None
+                if message_data.get('parent_message_id'):
+                    parent_message_info = await run_in_session(
+                        lookup_parent_message, message_data['parent_message_id']
+                    )
                 
-                message = Message(
+                # Id, seq and timestamp are assigned now; the row is group-committed later
+                message, committed = await message_writer.submit(
                     content=message_data['content'],
-                    user_id=current_user.id,
+                    user_id=user_id,
                     channel=channel_name,
                     parent_message_id=message_data.get('parent_message_id')
                 )
-                db.add(message)
-                db.commit()
-                db.refresh(message)
-                
-                # Get parent message info if this is a reply
-                parent_message_info = None
-                if message.parent_message_id:
-                    parent_message = db.query(Message).join(User).filter(Message.id == message.parent_message_id).first()
-                    if parent_message:
-                        parent_message_info = {
-                            'id': parent_message.id,
-                            'content': parent_message.content,
-                            'username': parent_message.user.username
-                        }
+                if message_writer.durability == DURABILITY_SYNC:
+                    # Batches commit in submit order, so waiters resume in seq order
+                    await committed
                 
-                # Prepare response data
+                # Protocol-neutral event; each wire protocol renders it (see chat_protocol)
                 response_data = {
-                    'id': message.id,
-                    'content': message.content,
-                    'username': current_user.username,
-                    'timestamp': message.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+                    'type': 'message',
+                    'id': message['id'],
+                    'seq': message['seq'],
+                    'content': message['content'],
+                    'username': username,
+                    'ts': epoch_ms(message['timestamp']),
+                    'parent_message_id': message['parent_message_id'],
                     'parent_message': parent_message_info
                 }
                 
-                await manager.broadcast(json.dumps(response_data))
+                await manager.broadcast(channel_name, response_data)
         except WebSocketDisconnect:
-            manager.disconnect(websocket)
+            pass
+        finally:
+            presence.leave(channel_name, user_id)
+            await manager.disconnect(websocket, channel_name)
     except Exception as e:
-        await websocket.close(code=1011)
-    finally:
-        db.close()
+        metrics.WEBSOCKET_ERRORS.inc()
+        print(f"WebSocket handler for channel {channel_name} failed: {e!r}")
+        traceback.print_exc()
+        try:
+            await websocket.close(code=1011)
+        except Exception:
+            # Already closed by the client or the server
+            pass
+
+@app.get("/metrics")
+async def metrics_page(request: Request):
+    if metrics.METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {metrics.METRICS_TOKEN}":
+        return JSONResponse(status_code=401, content={"detail": "Unauthorized"})
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/c/{channel_name}/presence")
+async def channel_presence(
+    channel_name: str,
+    current_user: Optional[User] = Depends(get_current_user)
+):
+    if not current_user:
+        return JSONResponse(status_code=401, content={"detail": "Unauthorized"})
+
+    return {
+        "online_count": presence.online_count(channel_name),
+        "users": presence.online_users(channel_name)
+    }
 
 @app.get("/channels")
 async def channels_page(
     request: Request,
     current_user: Optional[User] = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     if not current_user:
         return RedirectResponse(url="/login")
     
-    # Get all unique channels from messages
-    message_channels = db.query(Message.channel).distinct().all()
-    channels = sorted([channel[0] for channel in message_channels])
+    # Most recently active channels first
+    channel_stats = await channel_directory_page(db)
     
     return templates.TemplateResponse("channels.html", {
         "request": request,
         "user": current_user,
-        "channels": channels
+        "channels": [channel["name"] for channel in channel_stats],
+        "channel_stats": channel_stats
     })
 
 import routers.forum as forum
@@ -218,7 +469,7 @@ from routers import user
 import routers.polls as polls
 from routers import leaderboard
 from services import auth_service, chat_protocol
-from routers import profile, settings
+from routers import profile, settings, search
 
 # Add routers
 app.include_router(forum.router)
@@ -229,5 +480,6 @@ app.include_router(auth_service.router)
 app.include_router(chat_protocol.router)
 app.include_router(profile.router)
 app.include_router(settings.router)
+app.include_router(search.router)
 
 
@@ -1,6 +1,7 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, Enum
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, Enum, Index, LargeBinary, select, func, case, event, update
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, column_property, Session
+from collections import defaultdict
 from datetime import datetime
 import enum
 import random
@@ -30,21 +31,16 @@ class User(Base):
 
     submitted_reports = relationship("Report", back_populates="reporter")
 
-    @property
-    def message_count(self):
-        return len(self.messages)
-
-    @property
-    def post_count(self):
-        return len(self.posts)
+    # Activity counters, kept current on every flush (_count_changes below)
+    message_count = Column(Integer, nullable=False, default=0, server_default="0")
+    post_count = Column(Integer, nullable=False, default=0, server_default="0")
+    comment_count = Column(Integer, nullable=False, default=0, server_default="0")
+    total_interactions = Column(Integer, nullable=False, default=0, server_default="0")
 
-    @property
-    def comment_count(self):
-        return len(self.comments)
-
-    @property
-    def total_interactions(self):
-        return self.message_count + self.post_count + self.comment_count
+    __table_args__ = (
+        # Leaderboards read the top of this index
+        Index("ix_users_total_interactions", "total_interactions"),
+    )
 
     @classmethod
     def generate_unique_username(cls, db):
@@ -65,6 +61,10 @@ class PostView(Base):
     post = relationship("ForumPost", back_populates="views_by_users")
     user = relationship("User", back_populates="viewed_posts")
 
+    __table_args__ = (
+        Index("ix_post_views_post_user", "post_id", "user_id"),
+    )
+
 class PostTag(enum.Enum):
     EDUCATION = "Education"
     TECHNOLOGY = "Technology" 
@@ -91,18 +91,6 @@ class ForumPost(Base):
     views_by_users = relationship("PostView", back_populates="post")
     votes = relationship("PostVote", back_populates="post")
 
-    @property
-    def upvotes(self):
-        return sum(1 for vote in self.votes if vote.vote_type == 'up')
-
-    @property
-    def downvotes(self):
-        return sum(1 for vote in self.votes if vote.vote_type == 'down')
-
-    @property
-    def score(self):
-        return self.upvotes - self.downvotes
-
 
 class ForumComment(Base):
     __tablename__ = "forum_comments"
@@ -122,17 +110,9 @@ class ForumComment(Base):
     )
     votes = relationship("CommentVote", back_populates="comment")
 
-    @property
-    def upvotes(self):
-        return sum(1 for vote in self.votes if vote.vote_type == 'up')
-
-    @property
-    def downvotes(self):
-        return sum(1 for vote in self.votes if vote.vote_type == 'down')
-
-    @property
-    def score(self):
-        return self.upvotes - self.downvotes
+    __table_args__ = (
+        Index("ix_forum_comments_post_created_at", "post_id", "created_at"),
+    )
 
     def get_user_vote(self, user_id):
         user_vote = next((vote for vote in self.votes if vote.user_id == user_id), None)
@@ -146,6 +126,10 @@ class Message(Base):
     channel = Column(String, nullable=False, default="general")
     user_id = Column(Integer, ForeignKey("users.id"))
     parent_message_id = Column(Integer, ForeignKey("messages.id"), nullable=True)
+    # Per-channel sequence number; reconnecting clients resume from it
+    seq = Column(Integer, nullable=True)
+    # Direct replies, kept current by the message writer (services/threads.py)
+    reply_count = Column(Integer, nullable=False, default=0, server_default="0")
     user = relationship("User", back_populates="messages")
     replies = relationship(
         "Message",
@@ -154,6 +138,14 @@ class Message(Base):
     )
     reports = relationship("Report", back_populates="message")
 
+    __table_args__ = (
+        # History pages are keyset ranges over these
+        Index("ix_messages_channel_timestamp", "channel", "timestamp"),
+        Index("ix_messages_channel_seq", "channel", "seq"),
+        Index("ix_messages_parent_message_id", "parent_message_id"),
+        Index("ix_messages_user_id", "user_id"),
+    )
+
 class PostVote(Base):
     __tablename__ = "post_votes"
     id = Column(Integer, primary_key=True, index=True)
@@ -165,6 +157,11 @@ class PostVote(Base):
     post = relationship("ForumPost", back_populates="votes")
     user = relationship("User", back_populates="post_votes")
 
+    __table_args__ = (
+        # One vote per user per post; also serves the per-post tallies
+        Index("ux_post_votes_post_user", "post_id", "user_id", unique=True),
+    )
+
 class CommentVote(Base):
     __tablename__ = "comment_votes"
     id = Column(Integer, primary_key=True, index=True)
@@ -176,6 +173,10 @@ class CommentVote(Base):
     comment = relationship("ForumComment", back_populates="votes")
     user = relationship("User", back_populates="comment_votes")
 
+    __table_args__ = (
+        Index("ux_comment_votes_comment_user", "comment_id", "user_id", unique=True),
+    )
+
 class Poll(Base):
     __tablename__ = "polls"
     id = Column(Integer, primary_key=True, index=True)
@@ -185,19 +186,21 @@ class Poll(Base):
     ends_at = Column(DateTime, nullable=True)
     channel = Column(String, nullable=False)
     creator_id = Column(Integer, ForeignKey("users.id"))
+    # Bumped by every vote in the vote's transaction; orders live tally deltas (services/poll_tally.py)
+    vote_version = Column(Integer, nullable=False, default=0, server_default="0")
     
     creator = relationship("User", back_populates="created_polls")
     options = relationship("PollOption", back_populates="poll", cascade="all, delete-orphan")
+
+    __table_args__ = (
+        Index("ix_polls_channel_created_at", "channel", "created_at"),
+    )
     
     @property
     def is_active(self):
         if not self.ends_at:
             return True
         return datetime.utcnow() < self.ends_at
-    
-    @property
-    def total_votes(self):
-        return sum(option.votes_count for option in self.options)
 
 class PollOption(Base):
     __tablename__ = "poll_options"
@@ -207,10 +210,10 @@ class PollOption(Base):
     
     poll = relationship("Poll", back_populates="options")
     votes = relationship("PollVote", back_populates="option", cascade="all, delete-orphan")
-    
-    @property
-    def votes_count(self):
-        return len(self.votes)
+
+    __table_args__ = (
+        Index("ix_poll_options_poll_id", "poll_id"),
+    )
 
 class PollVote(Base):
     __tablename__ = "poll_votes"
@@ -222,6 +225,52 @@ class PollVote(Base):
     user = relationship("User", back_populates="poll_votes")
     option = relationship("PollOption", back_populates="votes")
 
+    __table_args__ = (
+        Index("ux_poll_votes_user_option", "user_id", "option_id", unique=True),
+        Index("ix_poll_votes_option_id", "option_id"),
+    )
+
+class Channel(Base):
+    """Directory entry per chat channel, kept current as messages are stored"""
+    __tablename__ = "channels"
+    name = Column(String, primary_key=True)
+    message_count = Column(Integer, nullable=False, default=0)
+    last_activity_at = Column(DateTime, nullable=True, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class MessageSegment(Base):
+    """Compressed, append-only block of archived messages of one channel (services/archive.py)"""
+    __tablename__ = "message_segments"
+    id = Column(Integer, primary_key=True)
+    channel = Column(String, nullable=False)
+    # Id and channel seq ranges covered; other segments and hot messages may fall inside them
+    first_id = Column(Integer, nullable=False)
+    last_id = Column(Integer, nullable=False)
+    first_seq = Column(Integer, nullable=False)
+    last_seq = Column(Integer, nullable=False)
+    first_timestamp = Column(DateTime, nullable=False)
+    last_timestamp = Column(DateTime, nullable=False)
+    message_count = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # History pages find the segments overlapping a seq range through this
+        Index("ix_message_segments_channel_last_seq", "channel", "last_seq"),
+    )
+
+class ArchivedMessageCount(Base):
+    """Messages per user moved to the archive, so activity counters can be recounted"""
+    __tablename__ = "archived_message_counts"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    message_count = Column(Integer, nullable=False, default=0)
+
+class IdAllocation(Base):
+    """Next free id per table for ids handed out before the row is written"""
+    __tablename__ = "id_allocations"
+    name = Column(String, primary_key=True)
+    next_value = Column(Integer, nullable=False)
+
 class ReportReason(enum.Enum):
     HARASSMENT = "Harassment"
     SPAM = "Spam"
@@ -242,4 +291,81 @@ class Report(Base):
     message = relationship("Message", back_populates="reports")
     reporter = relationship("User", back_populates="submitted_reports")
 
+    __table_args__ = (
+        # Reported messages are kept out of the archive
+        Index("ix_reports_message_id", "message_id"),
+    )
+
 
+# Vote tallies are correlated subqueries: they load with the row in the same
+# SELECT, can be used in ORDER BY/WHERE, and never materialize vote objects.
+# They are attached here because each one needs the vote class defined above.
+
+def _vote_count(vote_model, fk_column, owner_id, vote_type):
+    return select(func.count(vote_model.id)).where(
+        fk_column == owner_id, vote_model.vote_type == vote_type
+    ).correlate_except(vote_model).scalar_subquery()
+
+def _vote_score(vote_model, fk_column, owner_id):
+    return select(func.coalesce(func.sum(case(
+        (vote_model.vote_type == 'up', 1),
+        (vote_model.vote_type == 'down', -1),
+        else_=0
+    )), 0)).where(fk_column == owner_id).correlate_except(vote_model).scalar_subquery()
+
+ForumPost.upvotes = column_property(_vote_count(PostVote, PostVote.post_id, ForumPost.id, 'up'))
+ForumPost.downvotes = column_property(_vote_count(PostVote, PostVote.post_id, ForumPost.id, 'down'))
+ForumPost.score = column_property(_vote_score(PostVote, PostVote.post_id, ForumPost.id))
+
+ForumComment.upvotes = column_property(_vote_count(CommentVote, CommentVote.comment_id, ForumComment.id, 'up'))
+ForumComment.downvotes = column_property(_vote_count(CommentVote, CommentVote.comment_id, ForumComment.id, 'down'))
+ForumComment.score = column_property(_vote_score(CommentVote, CommentVote.comment_id, ForumComment.id))
+
+PollOption.votes_count = column_property(
+    select(func.count(PollVote.id)).where(
+        PollVote.option_id == PollOption.id
+    ).correlate_except(PollVote).scalar_subquery()
+)
+Poll.total_votes = column_property(
+    select(func.count(PollVote.id)).join(
+        PollOption, PollOption.id == PollVote.option_id
+    ).where(
+        PollOption.poll_id == Poll.id
+    ).correlate_except(PollVote, PollOption).scalar_subquery()
+)
+
+
+# Counted model -> (User counter column, author foreign key attribute)
+COUNTED = {
+    Message: ("message_count", "user_id"),
+    ForumPost: ("post_count", "author_id"),
+    ForumComment: ("comment_count", "author_id"),
+}
+
+def _count_changes(session, flush_context):
+    # Foreign keys are filled in by now, even for rows linked only through relationships
+    deltas = defaultdict(lambda: defaultdict(int))
+    for objects, step in ((session.new, 1), (session.deleted, -1)):
+        for obj in objects:
+            counted = COUNTED.get(type(obj))
+            if counted is None:
+                continue
+            column, author = counted
+            user_id = getattr(obj, author)
+            if user_id is not None:
+                deltas[user_id][column] += step
+    if not deltas:
+        return
+
+    connection = session.connection()
+    for user_id, changes in deltas.items():
+        total = sum(changes.values())
+        values = {column: getattr(User, column) + delta for column, delta in changes.items() if delta}
+        if total:
+            values["total_interactions"] = User.total_interactions + total
+        if values:
+            connection.execute(update(User).where(User.id == user_id).values(**values))
+
+# Registered here so every program using the models keeps the counters
+# current in the same transaction; services/user_counters.py repairs drift
+event.listen(Session, "after_flush", _count_changes)
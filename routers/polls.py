@@ -1,14 +1,18 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, Form
 from fastapi.responses import RedirectResponse, JSONResponse
+from sqlalchemy import update
 from sqlalchemy.orm import Session
 from typing import Optional, List
 from datetime import datetime, timedelta
 
-from main import get_db
+from main import get_db, get_read_db, manager
 from models import User, Poll, PollOption, PollVote
 from config import templates
 from sqlalchemy.exc import SQLAlchemyError
 from services.gcu import get_current_user
+from services.poll_service import format_polls
+from services.db_executor import run_db
+from services.poll_tally import poll_tally
 
 router = APIRouter(
     prefix="/p",
@@ -20,28 +24,14 @@ async def channel_polls(
     request: Request,
     channel_name: str,
     current_user: Optional[User] = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     if not current_user:
         return RedirectResponse(url="/login")
     
     try:
         # Get all polls for the channel
-        polls = db.query(Poll).filter(Poll.channel == channel_name).order_by(Poll.created_at.desc()).all()
-        
-        # Format polls data
-        formatted_polls = [{
-            "id": poll.id,
-            "title": poll.title,
-            "description": poll.description,
-            "created_at": poll.created_at,
-            "ends_at": poll.ends_at,
-            "is_active": poll.is_active,
-            "creator_username": poll.creator.username,
-            "options": [{"id": opt.id, "text": opt.text, "votes_count": opt.votes_count} for opt in poll.options],
-            "total_votes": poll.total_votes,
-            "user_vote": next((vote.option_id for vote in current_user.poll_votes if vote.option.poll_id == poll.id), None)
-        } for poll in polls]
+        formatted_polls = await run_db(format_polls, db, channel_name, current_user, newest_first=True)
 
         return templates.TemplateResponse("channel_polls.html", {
             "request": request,
@@ -80,14 +70,14 @@ async def create_poll(
             ends_at=ends_at
         )
         db.add(poll)
-        db.flush()
+        await run_db(db.flush)
 
         for option_text in options:
             if option_text.strip():
                 option = PollOption(text=option_text, poll_id=poll.id)
                 db.add(option)
 
-        db.commit()
+        await run_db(db.commit)
         return RedirectResponse(url=f"/p/{channel_name}", status_code=303)
     except SQLAlchemyError as e:
         print(f"Database error: {e}")
@@ -105,7 +95,7 @@ async def vote_on_poll(
         return JSONResponse(status_code=401, content={"detail": "Unauthorized"})
     
     # Check if poll exists
-    poll = db.query(Poll).filter(Poll.id == poll_id).first()
+    poll = await run_db(lambda: db.query(Poll).filter(Poll.id == poll_id).first())
     if not poll:
         return JSONResponse(status_code=404, content={"detail": "Poll not found"})
 
@@ -114,37 +104,73 @@ async def vote_on_poll(
         return JSONResponse(status_code=400, content={"detail": "Poll has ended"})
     
     # Check if option belongs to poll
-    option = db.query(PollOption).filter(
+    option = await run_db(lambda: db.query(PollOption).filter(
         PollOption.id == option_id,
         PollOption.poll_id == poll_id
-    ).first()
+    ).first())
     if not option:
         return JSONResponse(status_code=404, content={"detail": "Option not found"})
 
-    try:
-        existing_vote = db.query(PollVote).filter(
-            PollVote.user_id == current_user.id,
-            PollVote.option.has(poll_id=poll_id)
-        ).first()
-
-        if existing_vote:
-            if existing_vote.option_id == option_id:
-                db.delete(existing_vote)
+    # Read before the commit expires the instance
+    poll_channel = poll.channel
+
+    def apply_vote():
+        # Holding the poll's lock across the commit keeps the tally exact
+        with poll_tally.lock(poll_id):
+            existing_vote = db.query(PollVote).filter(
+                PollVote.user_id == current_user.id,
+                PollVote.option.has(poll_id=poll_id)
+            ).first()
+
+            deltas = {}
+            if existing_vote:
+                if existing_vote.option_id == option_id:
+                    db.delete(existing_vote)
+                    deltas[option_id] = -1
+                    user_vote = None
+                else:
+                    deltas[existing_vote.option_id] = -1
+                    deltas[option_id] = 1
+                    existing_vote.option_id = option_id
+                    user_vote = option_id
             else:
-                existing_vote.option_id = option_id
-        else:
-            vote = PollVote(user_id=current_user.id, option_id=option_id)
-            db.add(vote)
+                vote = PollVote(user_id=current_user.id, option_id=option_id)
+                db.add(vote)
+                deltas[option_id] = 1
+                user_vote = option_id
+
+            # Numbers this vote among all workers' votes on the poll
+            version = db.execute(
+                update(Poll).where(Poll.id == poll_id)
+                .values(vote_version=Poll.vote_version + 1)
+                .returning(Poll.vote_version)
+            ).scalar()
+            db.commit()
+            counts = poll_tally.apply(db, poll_id, deltas, version)
+        return deltas, counts, user_vote, version
+
+    try:
+        deltas, counts, user_vote, version = await run_db(apply_vote)
+        total_votes = sum(counts.values())
 
-        db.commit()
-        db.refresh(poll)
+        # Live update for everyone viewing the channel; counts are absolute so
+        # a coalesced (replaced) update still leaves clients correct. Other
+        # workers add the deltas to their tallies, so their counts stay current
+        await manager.broadcast(poll_channel, {
+            "type": "poll_update",
+            "poll_id": poll_id,
+            "deltas": deltas,
+            "counts": counts,
+            "total_votes": total_votes,
+            "version": version
+        }, key=f"poll:{poll_id}")
 
         # Return updated poll data
         return {
-            "poll_id": poll.id,
-            "options": [{"id": opt.id, "votes_count": opt.votes_count} for opt in poll.options],
-            "total_votes": poll.total_votes,
-            "user_vote": option_id if not existing_vote or existing_vote.option_id == option_id else None
+            "poll_id": poll_id,
+            "options": [{"id": opt_id, "votes_count": count} for opt_id, count in counts.items()],
+            "total_votes": total_votes,
+            "user_vote": user_vote
         }
     except SQLAlchemyError as e:
         print(f"Database error: {e}")
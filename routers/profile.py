@@ -1,12 +1,15 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, Form
 from fastapi.responses import RedirectResponse
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
 from typing import Optional
 
-from main import get_db
+from main import get_db, get_read_db
 from models import User
 from config import templates
-from services.gcu import get_current_user
+from services.gcu import get_current_user, invalidate_user
+from services.db_executor import run_db
+from services.user_counters import counters_for
 
 router = APIRouter(
     prefix="/profile",
@@ -17,14 +20,19 @@ router = APIRouter(
 async def profile_page(
     request: Request, 
     current_user: Optional[User] = Depends(get_current_user), 
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     if not current_user:
         return RedirectResponse(url="/login")
         
+    # Activity counters are stored columns, loaded up front so rendering never queries
+    counters = await run_db(counters_for, db, current_user.id)
+    for column, value in counters.items():
+        set_committed_value(current_user, column, value)
     return templates.TemplateResponse("profile.html", {
         "request": request,
         "user": current_user,
+        "counters": counters,
     })
 
 @router.post("/update")
@@ -45,7 +53,8 @@ async def update_profile(
         current_user.bio = bio
         current_user.avatar_url = avatar_url
         
-        db.commit()
+        await run_db(db.commit)
+        await invalidate_user(current_user.id)
         
         return RedirectResponse(url="/profile", status_code=303)
     except Exception as e:
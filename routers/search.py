@@ -0,0 +1,65 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import JSONResponse
+from sqlalchemy.orm import Session
+from typing import Optional
+
+from main import get_read_db
+from models import User
+from services.gcu import get_current_user
+from services.db_executor import run_db
+from services.db_engines import SEARCH_STATEMENT_TIMEOUT, set_statement_timeout
+from services.search import search_index, SEARCH_PAGE_SIZE
+
+router = APIRouter(
+    prefix="/search",
+    tags=["search"]
+)
+
+
+@router.get("/messages")
+async def search_messages(
+    q: str,
+    channel: Optional[str] = None,
+    author: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = SEARCH_PAGE_SIZE,
+    current_user: Optional[User] = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    if not current_user:
+        return JSONResponse(status_code=401, content={"detail": "Unauthorized"})
+
+    set_statement_timeout(SEARCH_STATEMENT_TIMEOUT)
+    try:
+        results, next_cursor = await run_db(
+            search_index.search_messages, db, q,
+            channel=channel, author=author, cursor=cursor, limit=limit
+        )
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"detail": str(e)})
+
+    return {"results": results, "next_cursor": next_cursor}
+
+
+@router.get("/posts")
+async def search_posts(
+    q: str,
+    author: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = SEARCH_PAGE_SIZE,
+    current_user: Optional[User] = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    if not current_user:
+        return JSONResponse(status_code=401, content={"detail": "Unauthorized"})
+
+    set_statement_timeout(SEARCH_STATEMENT_TIMEOUT)
+    try:
+        results, next_cursor = await run_db(
+            search_index.search_posts, db, q,
+            author=author, cursor=cursor, limit=limit
+        )
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"detail": str(e)})
+
+    return {"results": results, "next_cursor": next_cursor}
@@ -3,10 +3,12 @@ from fastapi.responses import RedirectResponse
 from sqlalchemy.orm import Session
 from typing import Optional
 
-from main import get_db, pwd_context
+from main import get_db
 from models import User
 from config import templates
-from services.gcu import get_current_user
+from services.gcu import get_current_user, invalidate_user
+from services.password_hasher import password_hasher
+from services.db_executor import run_db
 
 router = APIRouter(
     prefix="",
@@ -33,7 +35,7 @@ async def generate_username(
     if not current_user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    new_username = User.generate_unique_username(db)
+    new_username = await run_db(User.generate_unique_username, db)
     return {"username": new_username}
 
 @router.post("/api/settings/profile")
@@ -47,12 +49,13 @@ async def update_profile(
     
     # Check if username is taken by another user
     if username != current_user.username:
-        existing_user = db.query(User).filter(User.username == username).first()
+        existing_user = await run_db(lambda: db.query(User).filter(User.username == username).first())
         if existing_user:
             raise HTTPException(status_code=400, detail="Username already taken")
         current_user.username = username
     
-    db.commit()
+    await run_db(db.commit)
+    await invalidate_user(current_user.id)
     return RedirectResponse(url="/settings", status_code=303)
 
 @router.post("/api/settings/password")
@@ -67,7 +70,7 @@ async def change_password(
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     # Verify current password
-    if not pwd_context.verify(current_password, current_user.password):
+    if not await password_hasher.verify(current_password, current_user.password):
         raise HTTPException(status_code=400, detail="Current password is incorrect")
     
     # Verify new passwords match
@@ -75,7 +78,8 @@ async def change_password(
         raise HTTPException(status_code=400, detail="New passwords do not match")
     
     # Update password
-    current_user.password = pwd_context.hash(new_password)
-    db.commit()
+    current_user.password = await password_hasher.hash(new_password)
+    await run_db(db.commit)
+    await invalidate_user(current_user.id)
     
     return RedirectResponse(url="/settings", status_code=303)
@@ -0,0 +1,221 @@
+"""Cold storage for old chat messages.
+
+Messages older than ``ARCHIVE_AFTER_DAYS`` move out of ``messages`` into
+``message_segments``: zlib-compressed, append-only blocks of up to
+``ARCHIVE_SEGMENT_SIZE`` messages of one channel. The segment rows carry
+the channel ``seq`` range they cover and act as the offset index, so a
+history page only decompresses the segments overlapping it. ``fetch_history`` merges
+them with the hot table, so clients page across the boundary unaware.
+
+Some old messages stay hot: reported ones, and parents of replies that
+are still hot, so reply previews and moderation keep working. Archived
+messages are no longer in search results or reply threads.
+
+    python -m services.archive                  # archive every channel
+    python -m services.archive --days 30 --channel general
+"""
+import argparse
+import json
+import os
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import delete, exists, update
+from sqlalchemy.orm import Session, aliased, joinedload
+
+from models import ArchivedMessageCount, Message, MessageSegment, Report, User
+
+# Age after which messages are moved to the archive
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+# Messages per segment; each history page decompresses whole segments
+ARCHIVE_SEGMENT_SIZE = int(os.getenv("ARCHIVE_SEGMENT_SIZE", "500"))
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _archivable(db: Session, channel: str, cutoff: datetime, limit: int) -> List[Message]:
+    """The channel's oldest messages that may move to the archive"""
+    reply = aliased(Message)
+    return db.query(Message).options(joinedload(Message.parent_message)).filter(
+        Message.channel == channel,
+        Message.timestamp < cutoff,
+        ~exists().where(reply.parent_message_id == Message.id, reply.timestamp >= cutoff),
+        ~exists().where(Report.message_id == Message.id),
+    ).order_by(Message.seq).limit(limit).all()
+
+
+def _record(msg: Message) -> dict:
+    record = {
+        "id": msg.id,
+        "seq": msg.seq,
+        "user_id": msg.user_id,
+        "content": msg.content,
+        "timestamp": msg.timestamp.strftime(TIMESTAMP_FORMAT),
+        "reply_count": msg.reply_count or 0,
+    }
+    parent = msg.parent_message
+    if parent is not None:
+        # The parent may be archived in another segment; keep what the preview needs
+        record["parent"] = {"id": parent.id, "content": parent.content, "user_id": parent.user_id}
+    return record
+
+
+def encode_segment(records: List[dict]) -> bytes:
+    return zlib.compress(json.dumps(records, separators=(",", ":")).encode())
+
+
+def decode_segment(data: bytes) -> List[dict]:
+    return json.loads(zlib.decompress(data))
+
+
+def archive_segment(db: Session, channel: str, cutoff: datetime, size: int = ARCHIVE_SEGMENT_SIZE) -> int:
+    """Move up to ``size`` of the channel's archivable messages into one segment.
+
+    Everything happens in one transaction: if another archiver moved some
+    of the same rows first, nothing is written. Returns messages moved.
+    """
+    rows = _archivable(db, channel, cutoff, size)
+    if not rows:
+        return 0
+    records = [_record(msg) for msg in rows]
+    ids = [msg.id for msg in rows]
+    authors = Counter(msg.user_id for msg in rows if msg.user_id is not None)
+    db.expunge_all()
+
+    try:
+        db.add(MessageSegment(
+            channel=channel,
+            first_id=min(ids),
+            last_id=max(ids),
+            first_seq=records[0]["seq"],
+            last_seq=records[-1]["seq"],
+            first_timestamp=rows[0].timestamp,
+            last_timestamp=rows[-1].timestamp,
+            message_count=len(records),
+            data=encode_segment(records),
+        ))
+        # Archived messages still count towards their authors' activity
+        for user_id, count in authors.items():
+            result = db.execute(update(ArchivedMessageCount).where(
+                ArchivedMessageCount.user_id == user_id
+            ).values(message_count=ArchivedMessageCount.message_count + count))
+            if not result.rowcount:
+                db.add(ArchivedMessageCount(user_id=user_id, message_count=count))
+        moved = db.execute(
+            delete(Message).where(Message.id.in_(ids)),
+            execution_options={"synchronize_session": False},
+        ).rowcount
+        if moved != len(ids):
+            db.rollback()
+            return 0
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(ids)
+
+
+def archive_channel(db: Session, channel: str, older_than_days: int = ARCHIVE_AFTER_DAYS,
+                    size: int = ARCHIVE_SEGMENT_SIZE) -> int:
+    """Archive everything archivable in ``channel``; returns messages moved"""
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    total = 0
+    while True:
+        moved = archive_segment(db, channel, cutoff, size)
+        total += moved
+        if moved < size:
+            return total
+
+
+def fetch_archived(
+    db: Session,
+    channel: str,
+    before_seq: Optional[int] = None,
+    after_seq: Optional[int] = None,
+    limit: int = 50,
+) -> List[dict]:
+    """Archived messages with ``after_seq < seq < before_seq``, newest first, formatted like history.
+
+    Reads the segment index (an index range when nothing is archived
+    there) and decompresses only the segments needed for ``limit``.
+    """
+    query = db.query(MessageSegment.id, MessageSegment.last_seq).filter(MessageSegment.channel == channel)
+    if after_seq is not None:
+        query = query.filter(MessageSegment.last_seq > after_seq)
+    if before_seq is not None:
+        query = query.filter(MessageSegment.first_seq < before_seq)
+    segments = query.order_by(MessageSegment.last_seq.desc()).all()
+
+    found: List[dict] = []
+    for segment_id, last_seq in segments:
+        if len(found) >= limit:
+            # Segments come newest-ending first; none of the rest can beat the page
+            found.sort(key=lambda r: r["seq"], reverse=True)
+            del found[limit:]
+            if last_seq < found[-1]["seq"]:
+                break
+        data = db.query(MessageSegment.data).filter(MessageSegment.id == segment_id).scalar()
+        found.extend(
+            record for record in decode_segment(data)
+            if (before_seq is None or record["seq"] < before_seq)
+            and (after_seq is None or record["seq"] > after_seq)
+        )
+    found.sort(key=lambda r: r["seq"], reverse=True)
+    return _format_records(db, found[:limit])
+
+
+def _format_records(db: Session, records: List[dict]) -> List[dict]:
+    if not records:
+        return []
+    user_ids = {r["user_id"] for r in records} | {r["parent"]["user_id"] for r in records if "parent" in r}
+    # Names are resolved now, so renamed users show their current name
+    usernames: Dict[int, str] = dict(db.query(User.id, User.username).filter(User.id.in_(user_ids)))
+    messages = []
+    for record in records:
+        message_data = {
+            "id": record["id"],
+            "seq": record["seq"],
+            "content": record["content"],
+            "username": usernames.get(record["user_id"]),
+            "timestamp": record["timestamp"],
+            "reply_count": record["reply_count"],
+        }
+        parent = record.get("parent")
+        if parent:
+            message_data["parent_message"] = {
+                "id": parent["id"],
+                "content": parent["content"],
+                "username": usernames.get(parent["user_id"]),
+            }
+        messages.append(message_data)
+    return messages
+
+
+def main():
+    from database import SessionLocal
+    from models import Channel
+
+    parser = argparse.ArgumentParser(description="Move old chat messages to the compressed archive")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS, help="archive messages older than this")
+    parser.add_argument("--channel", action="append", help="only these channels (repeatable)")
+    parser.add_argument("--segment-size", type=int, default=ARCHIVE_SEGMENT_SIZE)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        channels = args.channel or [name for (name,) in db.query(Channel.name).order_by(Channel.name)]
+        total = 0
+        for channel in channels:
+            moved = archive_channel(db, channel, args.days, args.segment_size)
+            if moved:
+                print(f"{channel}: archived {moved} message(s)")
+            total += moved
+        print(f"Archived {total} message(s) older than {args.days} day(s)")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
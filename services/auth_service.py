@@ -3,9 +3,11 @@ from fastapi.responses import RedirectResponse
 from sqlalchemy.orm import Session
 import jwt
 
-from main import get_db, pwd_context
+from main import get_db
 from models import User
 from config import SECRET_KEY
+from services.password_hasher import password_hasher
+from services.db_executor import run_db
 
 router = APIRouter(
     prefix="/auth",
@@ -18,14 +20,14 @@ async def register(
     password: str = Form(...),
     db: Session = Depends(get_db)
 ):
-    existing_user = db.query(User).filter(User.username == username).first()
+    existing_user = await run_db(lambda: db.query(User).filter(User.username == username).first())
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already registered")
     
-    hashed_password = pwd_context.hash(password)
+    hashed_password = await password_hasher.hash(password)
     user = User(username=username, password=hashed_password)
     db.add(user)
-    db.commit()
+    await run_db(db.commit)
     
     return RedirectResponse(url="/login", status_code=303)
 
@@ -35,8 +37,8 @@ async def login(
     password: str = Form(...),
     db: Session = Depends(get_db)
 ):
-    user = db.query(User).filter(User.username == username).first()
-    if not user or not pwd_context.verify(password, user.password):
+    user = await run_db(lambda: db.query(User).filter(User.username == username).first())
+    if not user or not await password_hasher.verify(password, user.password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     token = jwt.encode({"username": username}, SECRET_KEY, algorithm="HS256")
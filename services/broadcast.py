@@ -0,0 +1,282 @@
+"""Broadcast backends that carry channel events between workers"""
+import asyncio
+import json
+import os
+from typing import Callable, Dict, Optional, Set
+from urllib.parse import unquote, urlparse
+
+# memory:// keeps fan-out inside this process; redis://host:port or
+# unix:///path/to/redis.sock shares it between workers through any server
+# speaking the Redis protocol (Redis, Valkey, KeyDB, a local stand-in...)
+BROADCAST_URL = os.getenv("BROADCAST_URL", "memory://")
+# Seconds a publish or sequence command may take before its connection is dropped
+BROADCAST_TIMEOUT = float(os.getenv("BROADCAST_TIMEOUT", "2"))
+
+# Callback invoked with (channel, message) for every message received
+MessageHandler = Callable[[str, dict], None]
+
+
+class BroadcastBackend:
+    """Publish/subscribe transport used by ConnectionManager.
+
+    A worker subscribes to a channel while it holds at least one local
+    socket in that room and unsubscribes when the last one leaves, so it
+    only receives traffic it can deliver. Messages published by a worker
+    come back to it through its own subscription.
+    """
+
+    # False when every publisher is in this process, so nothing is ever missed
+    shared = True
+
+    async def start(self, on_message: MessageHandler):
+        raise NotImplementedError
+
+    async def stop(self):
+        raise NotImplementedError
+
+    async def subscribe(self, channel: str):
+        raise NotImplementedError
+
+    async def unsubscribe(self, channel: str):
+        raise NotImplementedError
+
+    async def publish(self, channel: str, message: dict):
+        raise NotImplementedError
+
+    async def next_sequence(self, channel: str, floor: int = 0) -> int:
+        """Next sequence number for ``channel``, shared by all workers.
+
+        ``floor`` is the highest number already stored for the channel;
+        the counter never hands out anything at or below it.
+        """
+        raise NotImplementedError
+
+
+class InProcessBackend(BroadcastBackend):
+    """Single-worker backend; messages are handed straight back to the manager"""
+
+    shared = False
+
+    def __init__(self):
+        self._on_message: Optional[MessageHandler] = None
+        self._channels: Set[str] = set()
+        self._sequences: Dict[str, int] = {}
+
+    async def start(self, on_message: MessageHandler):
+        self._on_message = on_message
+
+    async def stop(self):
+        self._on_message = None
+        self._channels.clear()
+
+    async def subscribe(self, channel: str):
+        self._channels.add(channel)
+
+    async def unsubscribe(self, channel: str):
+        self._channels.discard(channel)
+
+    async def publish(self, channel: str, message: dict):
+        if self._on_message is not None and channel in self._channels:
+            self._on_message(channel, message)
+
+    async def next_sequence(self, channel: str, floor: int = 0) -> int:
+        value = max(self._sequences.get(channel, 0), floor) + 1
+        self._sequences[channel] = value
+        return value
+
+
+class RespError(Exception):
+    pass
+
+
+def _encode_command(*args) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def _read_reply(reader: asyncio.StreamReader):
+    line = await reader.readuntil(b"\r\n")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest
+    if kind == b"-":
+        raise RespError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        length = int(rest)
+        if length < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(length)]
+    raise RespError(f"Unexpected reply type: {line!r}")
+
+
+class RedisBackend(BroadcastBackend):
+    """Redis-protocol PUBLISH/SUBSCRIBE backend with no client library dependency.
+
+    Uses one connection for publishing and a second one in subscriber
+    mode. The subscriber reconnects with backoff and re-subscribes the
+    channels this worker still has sockets in.
+    """
+
+    def __init__(self, url: str, prefix: str = "peerchat:", timeout: float = BROADCAST_TIMEOUT):
+        parsed = urlparse(url)
+        self.unix_path = parsed.path if parsed.scheme == "unix" else None
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.prefix = prefix
+        self.timeout = timeout
+        self._on_message: Optional[MessageHandler] = None
+        self._channels: Set[str] = set()
+        self._pub: Optional[tuple] = None
+        self._pub_lock = asyncio.Lock()
+        self._sub_writer: Optional[asyncio.StreamWriter] = None
+        self._sub_task: Optional[asyncio.Task] = None
+
+    async def _open(self):
+        if self.unix_path:
+            reader, writer = await asyncio.open_unix_connection(self.unix_path)
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(_encode_command("AUTH", self.password))
+            await writer.drain()
+            await _read_reply(reader)
+        return reader, writer
+
+    async def start(self, on_message: MessageHandler):
+        self._on_message = on_message
+        self._pub = await self._open()
+        self._sub_task = asyncio.create_task(self._subscriber())
+
+    async def stop(self):
+        if self._sub_task is not None:
+            self._sub_task.cancel()
+            try:
+                await self._sub_task
+            except asyncio.CancelledError:
+                pass
+            self._sub_task = None
+        if self._pub is not None:
+            self._pub[1].close()
+            self._pub = None
+        self._channels.clear()
+
+    async def _subscriber(self):
+        delay = 0.1
+        while True:
+            try:
+                reader, writer = await self._open()
+                # Publish the writer first so subscribe() calls racing the
+                # initial SUBSCRIBE below are not lost
+                self._sub_writer = writer
+                if self._channels:
+                    writer.write(_encode_command(
+                        "SUBSCRIBE", *(self.prefix + c for c in self._channels)
+                    ))
+                    await writer.drain()
+                delay = 0.1
+                while True:
+                    reply = await _read_reply(reader)
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                        self._dispatch(reply[1].decode(), reply[2])
+            except asyncio.CancelledError:
+                if self._sub_writer is not None:
+                    self._sub_writer.close()
+                raise
+            except (OSError, asyncio.IncompleteReadError, RespError) as e:
+                print(f"Broadcast subscriber error: {e}")
+            self._sub_writer = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5)
+
+    def _dispatch(self, name: str, payload: bytes):
+        if self._on_message is None or not name.startswith(self.prefix):
+            return
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            return
+        self._on_message(name[len(self.prefix):], message)
+
+    async def _send_subscription(self, command: str, channel: str):
+        # While disconnected the reconnect loop re-subscribes from self._channels
+        writer = self._sub_writer
+        if writer is None:
+            return
+        try:
+            writer.write(_encode_command(command, self.prefix + channel))
+            await writer.drain()
+        except OSError as e:
+            print(f"Broadcast {command.lower()} error: {e}")
+
+    async def subscribe(self, channel: str):
+        self._channels.add(channel)
+        await self._send_subscription("SUBSCRIBE", channel)
+
+    async def unsubscribe(self, channel: str):
+        self._channels.discard(channel)
+        await self._send_subscription("UNSUBSCRIBE", channel)
+
+    async def _round_trip(self, command: bytes):
+        if self._pub is None:
+            self._pub = await self._open()
+        reader, writer = self._pub
+        writer.write(command)
+        await writer.drain()
+        return await _read_reply(reader)
+
+    def _drop_pub(self):
+        if self._pub is not None:
+            self._pub[1].close()
+            self._pub = None
+
+    async def _command(self, *args):
+        """Run one command on the publishing connection and return its reply.
+
+        Bounded by ``timeout``: every sender on this worker queues behind
+        the lock, so a hung server must not hold it.
+        """
+        command = _encode_command(*args)
+        async with self._pub_lock:
+            for attempt in range(2):
+                try:
+                    return await asyncio.wait_for(self._round_trip(command), self.timeout)
+                except asyncio.TimeoutError as e:
+                    # A late reply would be read as the answer to the next command
+                    self._drop_pub()
+                    raise ConnectionError(f"Broadcast {args[0].lower()} timed out after {self.timeout}s") from e
+                except (OSError, asyncio.IncompleteReadError) as e:
+                    self._drop_pub()
+                    if attempt:
+                        raise ConnectionError(f"Broadcast {args[0].lower()} failed: {e}") from e
+
+    async def publish(self, channel: str, message: dict):
+        payload = json.dumps(message).encode()
+        await self._command("PUBLISH", self.prefix + channel, payload)
+
+    async def next_sequence(self, channel: str, floor: int = 0) -> int:
+        key = self.prefix + "seq:" + channel
+        if floor:
+            # Seeds the counter on first use; a no-op once any worker has
+            await self._command("SET", key, floor, "NX")
+        return await self._command("INCR", key)
+
+def create_backend(url: str = BROADCAST_URL) -> BroadcastBackend:
+    scheme = urlparse(url).scheme
+    if scheme == "memory":
+        return InProcessBackend()
+    if scheme in ("redis", "unix"):
+        return RedisBackend(url)
+    raise ValueError(f"Unsupported broadcast backend: {url}")
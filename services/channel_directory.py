@@ -0,0 +1,93 @@
+"""Channel directory backed by the channels table"""
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import case, func, insert, update
+from sqlalchemy.orm import Session
+
+from models import Channel, Message
+
+# Seconds a directory listing is served from memory before re-reading it
+CHANNEL_DIRECTORY_TTL = float(os.getenv("CHANNEL_DIRECTORY_TTL", "5"))
+
+
+def backfill_channels(db: Session) -> int:
+    """Build the channels table from existing messages if it is empty"""
+    if db.query(Channel.name).first() is not None:
+        return 0
+    db.execute(insert(Channel).from_select(
+        ["name", "message_count", "last_activity_at", "created_at"],
+        db.query(
+            Message.channel,
+            func.count(Message.id),
+            func.max(Message.timestamp),
+            func.min(Message.timestamp),
+        ).group_by(Message.channel)
+    ))
+    db.commit()
+    return db.query(func.count(Channel.name)).scalar()
+
+
+def record_activity(db: Session, rows: List[dict]):
+    """Fold a batch of new message rows into the directory.
+
+    Runs inside the caller's transaction, with one UPDATE per channel
+    touched by the batch rather than per message.
+    """
+    counts: Dict[str, int] = defaultdict(int)
+    latest: Dict[str, datetime] = {}
+    for row in rows:
+        channel = row["channel"]
+        counts[channel] += 1
+        if channel not in latest or row["timestamp"] > latest[channel]:
+            latest[channel] = row["timestamp"]
+
+    for channel, count in counts.items():
+        result = db.execute(update(Channel).where(Channel.name == channel).values(
+            message_count=Channel.message_count + count,
+            last_activity_at=case(
+                (Channel.last_activity_at > latest[channel], Channel.last_activity_at),
+                else_=latest[channel]
+            ),
+        ))
+        if not result.rowcount:
+            db.add(Channel(
+                name=channel,
+                message_count=count,
+                last_activity_at=latest[channel],
+            ))
+
+
+class ChannelDirectory:
+    """Channels ordered by last activity, cached in memory for a few seconds"""
+
+    def __init__(self, ttl: float = CHANNEL_DIRECTORY_TTL):
+        self.ttl = ttl
+        self._expires_at = 0.0
+        self._channels: List[dict] = []
+        self._lock = threading.Lock()
+
+    def list_channels(self, db: Session, limit: Optional[int] = None) -> List[dict]:
+        with self._lock:
+            if self._expires_at < time.monotonic():
+                self._channels = [{
+                    "name": channel.name,
+                    "message_count": channel.message_count,
+                    "last_activity_at": channel.last_activity_at,
+                } for channel in db.query(Channel).order_by(
+                    Channel.last_activity_at.desc()
+                )]
+                self._expires_at = time.monotonic() + self.ttl
+            channels = self._channels
+        return [dict(channel) for channel in channels[:limit]]
+
+    def invalidate(self):
+        with self._lock:
+            self._expires_at = 0.0
+
+
+channel_directory = ChannelDirectory()
@@ -0,0 +1,184 @@
+"""WebSocket wire protocols for chat.
+
+Clients pick a protocol with the WebSocket subprotocol header:
+
+- ``peerchat.v1.json`` (also used when no subprotocol is offered): the
+  original verbose JSON frames, with formatted timestamps and the full
+  parent message embedded in every reply.
+- ``peerchat.v2.json``: short keys, epoch-millisecond timestamps and the
+  parent sent by id only.
+- ``peerchat.v2.msgpack``: the v2 layout as binary MessagePack frames,
+  offered when the optional ``msgpack`` package is installed.
+
+Events are built once in a protocol-neutral form and each codec renders
+them, so a broadcast is encoded at most once per protocol in use.
+permessage-deflate is negotiated by the ASGI server (uvicorn enables it
+by default for its websockets implementation; see the README).
+"""
+import json
+from datetime import datetime
+from typing import Dict, Optional, Union
+
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+Frame = Union[str, bytes]
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+router = APIRouter(
+    prefix="/api/chat",
+    tags=["chat"]
+)
+
+
+def epoch_ms(value: datetime) -> int:
+    # Stored timestamps are naive UTC
+    return int((value - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def from_epoch_ms(value: int) -> datetime:
+    return datetime.utcfromtimestamp(value / 1000)
+
+
+class JsonV1:
+    """Original frames; chat messages keep their legacy shape"""
+    subprotocol: Optional[str] = "peerchat.v1.json"
+    name = "v1.json"
+
+    def render(self, event: dict) -> dict:
+        if event.get("type") != "message":
+            return event
+        return {
+            "id": event["id"],
+            "seq": event.get("seq"),
+            "content": event["content"],
+            "username": event["username"],
+            "timestamp": from_epoch_ms(event["ts"]).strftime(TIMESTAMP_FORMAT),
+            "parent_message": event.get("parent_message"),
+        }
+
+    def encode(self, event: dict) -> Frame:
+        return json.dumps(self.render(event))
+
+    def decode(self, frame: Frame) -> dict:
+        data = json.loads(frame)
+        if not isinstance(data, dict):
+            raise ValueError("Frame must be an object")
+        return data
+
+
+# Event type <-> short tag, and per-type field <-> short key
+V2_TYPES = {
+    "message": "m", "typing": "ty", "presence": "pr", "poll_update": "pu", "error": "e",
+    "resync": "rs",
+}
+V2_KEYS = {
+    "message": {"id": "i", "seq": "s", "content": "c", "username": "u", "ts": "ts",
+                "parent_message_id": "p"},
+    "typing": {},
+    "presence": {"joined": "j", "left": "l", "typing": "ty", "online_count": "n"},
+    "poll_update": {"poll_id": "i", "deltas": "d", "counts": "c", "total_votes": "n"},
+    "error": {"code": "c", "detail": "m", "retry_after_ms": "r"},
+    "resync": {"last_seq": "s"},
+}
+V2_TYPES_REVERSE = {short: name for name, short in V2_TYPES.items()}
+V2_KEYS_REVERSE = {name: {short: key for key, short in keys.items()} for name, keys in V2_KEYS.items()}
+
+
+class JsonV2:
+    """Short keys, epoch timestamps, parent by reference"""
+    subprotocol: Optional[str] = "peerchat.v2.json"
+    name = "v2.json"
+
+    def render(self, event: dict) -> dict:
+        kind = event.get("type", "message")
+        keys = V2_KEYS.get(kind)
+        if keys is None:
+            return event
+        rendered = {"t": V2_TYPES[kind]}
+        for key, short in keys.items():
+            value = event.get(key)
+            if value is not None:
+                rendered[short] = value
+        if kind == "message" and "p" not in rendered and event.get("parent_message"):
+            rendered["p"] = event["parent_message"]["id"]
+        return rendered
+
+    def parse(self, data: dict) -> dict:
+        kind = V2_TYPES_REVERSE.get(data.get("t"), "message")
+        keys = V2_KEYS_REVERSE[kind]
+        event = {"type": kind}
+        for short, value in data.items():
+            if short in keys:
+                event[keys[short]] = value
+        return event
+
+    def encode(self, event: dict) -> Frame:
+        return json.dumps(self.render(event), separators=(",", ":"))
+
+    def decode(self, frame: Frame) -> dict:
+        data = json.loads(frame)
+        if not isinstance(data, dict):
+            raise ValueError("Frame must be an object")
+        return self.parse(data)
+
+
+class MsgpackV2(JsonV2):
+    """The v2 layout as binary MessagePack frames"""
+    subprotocol: Optional[str] = "peerchat.v2.msgpack"
+    name = "v2.msgpack"
+
+    def encode(self, event: dict) -> Frame:
+        return msgpack.packb(self.render(event), use_bin_type=True)
+
+    def decode(self, frame: Frame) -> dict:
+        if isinstance(frame, str):
+            return super().decode(frame)
+        data = msgpack.unpackb(frame, raw=False, strict_map_key=False)
+        if not isinstance(data, dict):
+            raise ValueError("Frame must be a map")
+        return self.parse(data)
+
+
+class DefaultJsonV1(JsonV1):
+    """v1 for clients that did not ask for a subprotocol at all"""
+    subprotocol = None
+
+
+CODECS = [JsonV1(), JsonV2()] + ([MsgpackV2()] if msgpack is not None else [])
+CODECS_BY_SUBPROTOCOL: Dict[str, JsonV1] = {codec.subprotocol: codec for codec in CODECS}
+DEFAULT_CODEC = DefaultJsonV1()
+
+
+def negotiate(websocket: WebSocket):
+    """Pick the first subprotocol the client offered that we support"""
+    for offered in websocket.scope.get("subprotocols") or []:
+        codec = CODECS_BY_SUBPROTOCOL.get(offered)
+        if codec is not None:
+            return codec
+    return DEFAULT_CODEC
+
+
+async def receive_frame(websocket: WebSocket) -> Frame:
+    """Next text or binary frame from the client"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("text") is not None:
+        return message["text"]
+    return message.get("bytes") or b""
+
+
+@router.get("/protocols")
+async def list_protocols():
+    return {
+        "protocols": [codec.subprotocol for codec in CODECS],
+        "default": JsonV1.subprotocol,
+        "v2_types": V2_TYPES,
+        "v2_keys": V2_KEYS,
+    }
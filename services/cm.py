@@ -1,18 +1,253 @@
-from typing import List
+import asyncio
+import os
+import time
+import uuid
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
 from fastapi import WebSocket
 
+from services.broadcast import BroadcastBackend, create_backend
+from services.chat_protocol import DEFAULT_CODEC, Frame
+from services.message_cache import RecentMessages, ReplayBuffer, history_entry
+from services.metrics import FANOUT_SECONDS, WEBSOCKET_FRAMES_DROPPED, WEBSOCKET_FRAMES_SENT
+from services.poll_tally import PollTally, poll_tally as shared_poll_tally
+
+# Outbound frames a socket may have queued before the slow-consumer policy kicks in
+SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# What to do with a socket whose queue is full: drop_oldest, coalesce or disconnect
+SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+# Seconds a single send may take before the socket is considered stalled
+SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+SLOW_CONSUMER_POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+# Close code sent to evicted slow consumers ("try again later")
+CLOSE_SLOW_CONSUMER = 1013
+
+
+class Connection:
+    """One socket plus its bounded outbound queue and writer task.
+
+    Frames are queued by ``enqueue`` (never blocks) and sent by a writer
+    task owned by this connection, so a stalled client only ever delays
+    itself. With the ``coalesce`` policy a frame queued with a ``key``
+    replaces a still-queued frame carrying the same key.
+
+    A connection joined with ``hold`` queues frames without sending them
+    until ``release`` puts the replayed backlog in front of them.
+    """
+
+    def __init__(self, websocket: WebSocket, channel: str, max_queue: int, policy: str, codec=DEFAULT_CODEC):
+        self.websocket = websocket
+        self.channel = channel
+        self.max_queue = max_queue
+        self.policy = policy
+        self.codec = codec
+        # (coalesce key, frame, message seq)
+        self.queue: Deque[Tuple[Optional[str], Frame, Optional[int]]] = deque()
+        self.dropped = 0
+        self.closed = False
+        self._evict = False
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._writer())
+
+    def release(self, backlog: List[Tuple[Optional[int], Frame]]):
+        """Send ``backlog`` (seq, frame) pairs first, then start the held queue.
+
+        Live frames for messages that are also in the backlog are dropped.
+        """
+        replayed = {seq for seq, _ in backlog if seq is not None}
+        live = [entry for entry in self.queue if entry[2] is None or entry[2] not in replayed]
+        self.queue = deque([(None, frame, seq) for seq, frame in backlog] + live)
+        self.start()
+        self._wakeup.set()
+
+    def enqueue(self, frame: Frame, key: Optional[str] = None, seq: Optional[int] = None) -> bool:
+        if self.closed or self._evict:
+            return False
+
+        if key is not None and self.policy == COALESCE:
+            for i, (queued_key, _, _) in enumerate(self.queue):
+                if queued_key == key:
+                    self.queue[i] = (key, frame, seq)
+                    return True
+
+        if len(self.queue) >= self.max_queue:
+            if self.policy == DISCONNECT:
+                self._evict = True
+                self._wakeup.set()
+                return False
+            self.queue.popleft()
+            self.dropped += 1
+            WEBSOCKET_FRAMES_DROPPED.inc()
+
+        self.queue.append((key, frame, seq))
+        self._wakeup.set()
+        return True
+
+    async def _writer(self):
+        try:
+            while True:
+                while not self.queue and not self._evict:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                if self._evict:
+                    await self.websocket.close(code=CLOSE_SLOW_CONSUMER)
+                    return
+                _, frame, _ = self.queue.popleft()
+                if isinstance(frame, bytes):
+                    send = self.websocket.send_bytes(frame)
+                else:
+                    send = self.websocket.send_text(frame)
+                await asyncio.wait_for(send, SEND_TIMEOUT)
+                WEBSOCKET_FRAMES_SENT.inc()
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            # Stuck in a send for too long; dropping it frees the room's memory
+            try:
+                await self.websocket.close(code=CLOSE_SLOW_CONSUMER)
+            except Exception:
+                pass
+        except Exception:
+            # The receive loop notices the dead socket and calls disconnect()
+            pass
+        finally:
+            self.closed = True
+            self.queue.clear()
+
+    def stop(self):
+        self.closed = True
+        self.queue.clear()
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+
 # WebSocket connection manager
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    def __init__(
+        self,
+        max_queue: int = SEND_QUEUE_SIZE,
+        policy: str = SLOW_CONSUMER_POLICY,
+        backend: Optional[BroadcastBackend] = None,
+        replay_buffer: Optional[ReplayBuffer] = None,
+        recent_messages: Optional[RecentMessages] = None,
+        poll_tally: Optional[PollTally] = None,
+    ):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.max_queue = max_queue
+        self.policy = policy
+        self.backend = backend or create_backend()
+        # Recent chat messages of subscribed channels, for resuming sessions
+        self.replay_buffer = replay_buffer or ReplayBuffer()
+        # Newest formatted messages of hot channels, for page renders
+        self.recent_messages = recent_messages or RecentMessages()
+        # Live poll counts; votes made on other workers arrive as poll_update deltas
+        self.poll_tally = poll_tally or shared_poll_tally
+        # Tells this worker's own publications apart when they come back
+        self.worker_id = uuid.uuid4().hex
+        # channel name -> sockets currently in that room
+        self.rooms: Dict[str, Dict[WebSocket, Connection]] = {}
+        # Backend channels consumed by this worker itself rather than by sockets
+        self.listeners: Dict[str, Callable[[dict], None]] = {}
+
+    async def start(self):
+        await self.backend.start(self.deliver)
+
+    async def stop(self):
+        await self.backend.stop()
+
+    async def connect(
+        self, websocket: WebSocket, channel: str, codec=DEFAULT_CODEC, hold: bool = False
+    ) -> Connection:
+        await websocket.accept(subprotocol=codec.subprotocol)
+        return await self.join(websocket, channel, codec, hold)
+
+    async def join(
+        self, websocket: WebSocket, channel: str, codec=DEFAULT_CODEC, hold: bool = False
+    ) -> Connection:
+        """Add a socket to ``channel``; with ``hold`` nothing is sent until ``replay``"""
+        connection = Connection(websocket, channel, self.max_queue, self.policy, codec)
+        room = self.rooms.get(channel)
+        if room is None:
+            room = self.rooms[channel] = {}
+            await self.backend.subscribe(channel)
+        room[websocket] = connection
+        if not hold:
+            connection.start()
+        return connection
+
+    def replay(self, connection: Connection, events: List[dict]):
+        """Send missed message ``events`` to a held connection, then go live"""
+        codec = connection.codec
+        connection.release([(event.get("seq"), codec.encode(event)) for event in events])
+
+    async def listen(self, channel: str, handler: Callable[[dict], None]):
+        """Pass every message published to ``channel`` to ``handler``, on the loop"""
+        self.listeners[channel] = handler
+        await self.backend.subscribe(channel)
+
+    async def leave(self, websocket: WebSocket, channel: str):
+        room = self.rooms.get(channel)
+        if room is None:
+            return
+        connection = room.pop(websocket, None)
+        if connection is not None:
+            connection.stop()
+        if not room:
+            del self.rooms[channel]
+            # Messages published from now on never reach this worker's ring
+            self.replay_buffer.discard(channel)
+            await self.backend.unsubscribe(channel)
+
+    async def disconnect(self, websocket: WebSocket, channel: str):
+        await self.leave(websocket, channel)
+
+    def room_size(self, channel: str) -> int:
+        return len(self.rooms.get(channel, ()))
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
+    async def broadcast(self, channel: str, data: dict, key: Optional[str] = None):
+        """Publish ``data`` to every socket in ``channel`` on every worker"""
+        await self.backend.publish(channel, {"data": data, "key": key, "origin": self.worker_id})
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+    def deliver(self, channel: str, message: dict) -> int:
+        """Queue a published message for this worker's sockets in ``channel``.
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
\ No newline at end of file
+        The payload is encoded once per wire protocol in use and that frame
+        is shared by all recipients speaking it. Nothing here waits on a
+        socket. Returns how many sockets accepted the frame.
+        """
+        listener = self.listeners.get(channel)
+        if listener is not None:
+            listener(message)
+            return 0
+        data, key = message["data"], message.get("key")
+        room = self.rooms.get(channel)
+        if not room:
+            return 0
+        started = time.perf_counter()
+        seq = data.get("seq") if data.get("type") == "message" else None
+        if seq is not None:
+            self.replay_buffer.append(channel, data)
+            self.recent_messages.append(channel, history_entry(data))
+        elif data.get("type") == "poll_update" and message.get("origin") != self.worker_id:
+            # The voting worker applied these already; keep ours current so its counts never go back
+            self.poll_tally.apply_remote(data["poll_id"], data["deltas"], data["version"])
+        frames: Dict[str, Frame] = {}
+        delivered = 0
+        for connection in list(room.values()):
+            codec = connection.codec
+            frame = frames.get(codec.name)
+            if frame is None:
+                frame = frames[codec.name] = codec.encode(data)
+            if connection.enqueue(frame, key, seq):
+                delivered += 1
+        FANOUT_SECONDS.observe(time.perf_counter() - started)
+        return delivered
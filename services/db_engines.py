@@ -0,0 +1,125 @@
+"""Engine setup for read/write routing: read pool, SQLite tuning, statement timeouts.
+
+Writes always use the primary engine from ``database``. History,
+directory, poll and search reads use a read engine:
+
+- ``DATABASE_READ_URL`` when set (a replica, or any second pool);
+- otherwise, for a SQLite file, a read-only pool on the same file. The
+  primary is switched to WAL journaling so these readers never block a
+  commit and a commit never blocks them;
+- otherwise the primary engine itself.
+"""
+import os
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+
+# Read engine; defaults to the primary database (see module docstring)
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL")
+# Read pool sizing and health checks
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "10"))
+DB_READ_MAX_OVERFLOW = int(os.getenv("DB_READ_MAX_OVERFLOW", "10"))
+DB_READ_POOL_TIMEOUT = float(os.getenv("DB_READ_POOL_TIMEOUT", "30"))
+DB_READ_POOL_RECYCLE = int(os.getenv("DB_READ_POOL_RECYCLE", "1800"))
+DB_READ_POOL_PRE_PING = os.getenv("DB_READ_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# Milliseconds a SQLite connection waits on a lock before failing with "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# Seconds a single read statement may run before it is interrupted (0 disables)
+READ_STATEMENT_TIMEOUT = float(os.getenv("READ_STATEMENT_TIMEOUT", "5"))
+# Search scans can be longer than page reads
+SEARCH_STATEMENT_TIMEOUT = float(os.getenv("SEARCH_STATEMENT_TIMEOUT", "10"))
+
+# SQLite VM instructions between two timeout checks
+_PROGRESS_INTERVAL = 10000
+
+# Statement timeout, in seconds, for the code running in this context
+_statement_timeout: ContextVar[Optional[float]] = ContextVar("statement_timeout", default=None)
+
+
+def set_statement_timeout(seconds: Optional[float]):
+    """Limit each statement issued from the current context to ``seconds``.
+
+    The limit follows the context into ``run_db`` calls. Enforced on
+    SQLite, where a statement past its limit fails with "interrupted".
+    """
+    _statement_timeout.set(seconds or None)
+
+
+def default_statement_timeout(seconds: Optional[float]):
+    """``set_statement_timeout`` unless the context already has a limit"""
+    if _statement_timeout.get() is None:
+        set_statement_timeout(seconds)
+
+
+def _sqlite_file(engine: Engine) -> Optional[str]:
+    url = engine.url
+    if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+        return None
+    if url.query.get("mode") == "memory":
+        return None
+    return url.database
+
+
+def configure_sqlite(engine: Engine, wal: bool = False):
+    """Busy timeout and statement timeouts on every connection; WAL on the primary"""
+    if engine.url.get_backend_name() != "sqlite" or event.contains(engine, "connect", _on_connect):
+        return
+    event.listen(engine, "connect", _on_connect)
+    event.listen(engine, "before_cursor_execute", _statement_started)
+    if wal and _sqlite_file(engine):
+        event.listen(engine, "connect", _enable_wal)
+    # Connections opened before the listeners were added lack the settings
+    engine.dispose()
+
+
+def _on_connect(dbapi_connection, connection_record):
+    info = connection_record.info
+    info["statement_started"] = 0.0
+
+    def check_timeout():
+        # Non-zero interrupts the running statement
+        timeout = _statement_timeout.get()
+        return timeout is not None and time.monotonic() - info["statement_started"] > timeout
+
+    dbapi_connection.set_progress_handler(check_timeout, _PROGRESS_INTERVAL)
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+
+def _enable_wal(dbapi_connection, connection_record):
+    # Stored in the file; readers and the writer stop blocking each other
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode = WAL")
+    cursor.close()
+
+
+def _statement_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info["statement_started"] = time.monotonic()
+
+
+def create_read_engine(primary: Engine) -> Engine:
+    """The engine reads are routed to; see the module docstring"""
+    if DATABASE_READ_URL:
+        url = make_url(DATABASE_READ_URL)
+    else:
+        path = _sqlite_file(primary)
+        if path is None:
+            return primary
+        url = make_url(f"sqlite:///file:{path}?mode=ro&uri=true")
+
+    options = {"pool_pre_ping": DB_READ_POOL_PRE_PING, "pool_recycle": DB_READ_POOL_RECYCLE}
+    if url.get_backend_name() == "sqlite":
+        options["connect_args"] = {"check_same_thread": False}
+    if not (url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")):
+        options.update(
+            pool_size=DB_READ_POOL_SIZE,
+            max_overflow=DB_READ_MAX_OVERFLOW,
+            pool_timeout=DB_READ_POOL_TIMEOUT,
+        )
+    engine = create_engine(url, **options)
+    configure_sqlite(engine)
+    return engine
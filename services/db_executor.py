@@ -0,0 +1,182 @@
+"""Database sessions, routed to the primary or the read pool, and run off the event loop"""
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
+from typing import Optional
+
+from fastapi import Depends
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+import database
+from services.db_engines import (
+    READ_STATEMENT_TIMEOUT, configure_sqlite, create_read_engine, default_statement_timeout,
+)
+
+# Threads available for queries; size it to the connection pool
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "16"))
+# Connections kept free of request sessions for short executor jobs
+# (group commits, id blocks, run_in_session)
+DB_RESERVED_CONNECTIONS = int(os.getenv("DB_RESERVED_CONNECTIONS", "2"))
+
+# ``with session_scope() as db:`` opens a session and always closes it
+session_scope = contextmanager(database.get_db)
+
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+
+async def run_db(fn, *args, **kwargs):
+    """Await ``fn(*args, **kwargs)`` on the database executor.
+
+    Use it for anything that talks to the database from an ``async def``
+    handler, including commits. A Session is not thread-safe, but awaiting
+    each call before the next keeps one request's session on one thread
+    at a time. The call sees the caller's context variables.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_executor, partial(context.run, fn, *args, **kwargs))
+
+
+async def run_in_session(fn, *args, **kwargs):
+    """Await ``fn(db, *args, **kwargs)`` with a session that lives only for that call.
+
+    Meant for long-lived WebSocket handlers, which should not pin a
+    session and its connection for the lifetime of the socket.
+    """
+    def call():
+        with session_scope() as db:
+            return fn(db, *args, **kwargs)
+    return await run_db(call)
+
+
+def pool_capacity(engine) -> Optional[int]:
+    """Most connections ``engine`` will open at once, or None if unbounded"""
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return None
+    overflow = pool._max_overflow
+    return None if overflow < 0 else pool.size() + overflow
+
+
+class SessionAdmission:
+    """Opens request-scoped sessions of one engine only while its pool can back them.
+
+    A session keeps its connection between ``run_db`` calls, while it
+    holds no thread. With more such sessions than pooled connections,
+    every executor thread can end up waiting for a connection that only
+    a session waiting for a thread could return. Capping the sessions
+    below the pool size keeps a connection free for the threads, so the
+    excess requests wait here, on the loop, instead.
+    """
+
+    def __init__(self, factory, engine, slots_setting: str):
+        self.factory = factory
+        self.engine = engine
+        self.slots_setting = slots_setting
+        self._slots = None
+
+    def _limit(self) -> Optional[int]:
+        configured = os.getenv(self.slots_setting)
+        if configured:
+            return int(configured)
+        capacity = pool_capacity(self.engine)
+        return None if capacity is None else max(1, capacity - DB_RESERVED_CONNECTIONS)
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one admission slot; close any session using it before leaving"""
+        if self._slots is None:
+            limit = self._limit()
+            self._slots = asyncio.Semaphore(limit) if limit else False
+        if self._slots:
+            await self._slots.acquire()
+        try:
+            yield
+        finally:
+            if self._slots:
+                self._slots.release()
+
+    @asynccontextmanager
+    async def session(self):
+        async with self.slot():
+            db = self.factory()
+            try:
+                yield db
+            finally:
+                await run_db(db.close)
+
+
+# Writes, and reads that must see the latest commit, use the primary
+primary = SessionAdmission(database.SessionLocal, database.engine, "DB_SESSION_SLOTS")
+configure_sqlite(database.engine, wal=True)
+
+# History, directory, poll and search reads use the read pool (see services.db_engines)
+read_engine = create_read_engine(database.engine)
+if read_engine is database.engine:
+    # No separate read pool: both kinds of session share the primary's slots
+    ReadSessionLocal = database.SessionLocal
+    replica = primary
+else:
+    ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+    replica = SessionAdmission(ReadSessionLocal, read_engine, "DB_READ_SESSION_SLOTS")
+
+
+async def get_session():
+    """Request-scoped primary session that holds no admission slot.
+
+    Only for work that never touches a connection, like attaching the
+    cached user (``services.gcu``). Routes that query depend on ``get_db``,
+    which admits this same session.
+    """
+    db = database.SessionLocal()
+    try:
+        yield db
+    finally:
+        await run_db(db.close)
+
+
+async def get_db(db: Session = Depends(get_session)):
+    """Request-scoped session on the primary database"""
+    async with primary.slot():
+        try:
+            yield db
+        finally:
+            # Return the connection before the slot
+            await run_db(db.close)
+
+
+async def get_read_db():
+    """Request-scoped read-only session on the read pool, with the read statement timeout by default"""
+    default_statement_timeout(READ_STATEMENT_TIMEOUT)
+    async with replica.session() as db:
+        yield db
+
+
+# ``async with db_session() as db:`` for handlers that are not FastAPI dependencies
+db_session = primary.session
+
+
+@contextmanager
+def read_session_scope():
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def run_in_read_session(fn, *args, **kwargs):
+    """``run_in_session`` on the read pool"""
+    def call():
+        default_statement_timeout(READ_STATEMENT_TIMEOUT)
+        with read_session_scope() as db:
+            return fn(db, *args, **kwargs)
+    return await run_db(call)
+
+
+def shutdown():
+    _executor.shutdown(wait=True)
@@ -1,22 +1,140 @@
 """Get current user"""
-from typing import Optional
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
 from fastapi import Depends, Cookie
-from sqlalchemy.orm import Session
-from database import get_db
+from sqlalchemy.orm import Session, make_transient_to_detached
+from services.db_executor import get_session
 from models import User
 from config import SECRET_KEY
+from services.db_executor import run_in_session
+from services.cm import ConnectionManager
 import jwt
 
+# Tokens remembered at once, and seconds before a cached user is re-read
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "60"))
 
-async def get_current_user(session_token: Optional[str] = Cookie(None), db: Session = Depends(get_db)):
+# Backend channel carrying invalidations to the other workers' caches;
+# chat channel names never contain "/"
+AUTH_INVALIDATION_CHANNEL = "auth/invalidate"
+
+# Columns copied into the cached snapshot; anything else loads lazily on access
+SNAPSHOT_COLUMNS = ("id", "username", "password", "bio", "avatar_url", "created_at")
+
+
+class AuthCache:
+    """Bounded LRU of token -> (decoded claims, user column snapshot) with a TTL"""
+
+    def __init__(self, maxsize: int = AUTH_CACHE_SIZE, ttl: float = AUTH_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, dict, dict]]" = OrderedDict()
+        self._tokens_by_user: Dict[int, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[Tuple[dict, dict]]:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            expires_at, claims, snapshot = entry
+            if expires_at < time.monotonic():
+                self._remove(token)
+                return None
+            self._entries.move_to_end(token)
+            return claims, snapshot
+
+    def put(self, token: str, claims: dict, user: User) -> dict:
+        snapshot = {column: getattr(user, column) for column in SNAPSHOT_COLUMNS}
+        with self._lock:
+            self._remove(token)
+            self._entries[token] = (time.monotonic() + self.ttl, claims, snapshot)
+            self._tokens_by_user.setdefault(snapshot["id"], set()).add(token)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+        return snapshot
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            for token in list(self._tokens_by_user.get(user_id, ())):
+                self._remove(token)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+
+    def _remove(self, token: str):
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return
+        user_id = entry[2]["id"]
+        tokens = self._tokens_by_user.get(user_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[user_id]
+
+
+auth_cache = AuthCache()
+
+# Set by share_invalidations once the broadcast backend is running
+_manager: Optional[ConnectionManager] = None
+
+
+async def share_invalidations(manager: ConnectionManager):
+    """Apply invalidations published by other workers to this worker's cache"""
+    global _manager
+    _manager = manager
+    if manager.backend.shared:
+        await manager.listen(
+            AUTH_INVALIDATION_CHANNEL, lambda message: auth_cache.invalidate_user(message["data"]["user_id"])
+        )
+
+
+async def invalidate_user(user_id: int):
+    """Drop cached sessions of a user on every worker; call after changing their username or password"""
+    auth_cache.invalidate_user(user_id)
+    if _manager is None or not _manager.backend.shared:
+        return
+    try:
+        await _manager.broadcast(AUTH_INVALIDATION_CHANNEL, {"user_id": user_id})
+    except Exception as e:
+        # The change is committed; other workers drop the entry within AUTH_CACHE_TTL
+        print(f"Could not publish auth invalidation for user {user_id}: {e}")
+
+
+def _attach_snapshot(db: Session, snapshot: dict) -> User:
+    # Rebuild the row as a detached instance and attach it without a SELECT;
+    # relationships and columns outside the snapshot still load on access
+    user = User(**snapshot)
+    make_transient_to_detached(user)
+    return db.merge(user, load=False)
+
+
+def _find_user(db: Session, username: str) -> Optional[User]:
+    return db.query(User).filter(User.username == username).first()
+
+
+async def get_current_user(session_token: Optional[str] = Cookie(None), db: Session = Depends(get_session)):
+    # The user is attached to the request's session without a query, so
+    # routes that only read the user never take a primary admission slot
     if not session_token:
         return None
+    cached = auth_cache.get(session_token)
+    if cached is not None:
+        return _attach_snapshot(db, cached[1])
     try:
         payload = jwt.decode(session_token, SECRET_KEY, algorithms=["HS256"])
         username = payload.get("username")
         if username:
-            user = db.query(User).filter(User.username == username).first()
-            return user
+            user = await run_in_session(_find_user, username)
+            if user:
+                return _attach_snapshot(db, auth_cache.put(session_token, payload, user))
+            return None
     except jwt.InvalidTokenError:
         return None
     return None
@@ -0,0 +1,112 @@
+"""Channel message history, newest page first"""
+from typing import List, Optional, Tuple
+
+from sqlalchemy.orm import Session, contains_eager, joinedload
+
+from models import Message
+from services.archive import fetch_archived
+from services.chat_protocol import epoch_ms
+
+# Messages rendered with the channel page and returned per history request
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 200
+# Most messages a reconnecting client gets replayed before it must reload
+MAX_REPLAY_MESSAGES = 1000
+
+
+def format_message(msg: Message, include_parent: bool = True) -> dict:
+    """Viewer-independent dict for a message; callers add ``is_own``.
+
+    Expects ``user`` and ``parent_message`` to be loaded already (see
+    ``fetch_history``), otherwise each access is a query of its own.
+    """
+    message_data = {
+        "id": msg.id,
+        "seq": msg.seq,
+        "content": msg.content,
+        "username": msg.user.username,
+        "timestamp": msg.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+        "reply_count": msg.reply_count or 0,
+    }
+
+    parent = msg.parent_message if include_parent and msg.parent_message_id else None
+    if parent:
+        message_data["parent_message"] = {
+            "id": parent.id,
+            "content": parent.content,
+            "username": parent.user.username
+        }
+
+    return message_data
+
+
+def fetch_history(
+    db: Session,
+    channel: str,
+    before_seq: Optional[int] = None,
+    limit: int = HISTORY_PAGE_SIZE,
+) -> Tuple[List[dict], Optional[int]]:
+    """Return up to ``limit`` messages before ``before_seq``, oldest first.
+
+    Pages are a keyset range over the (channel, seq) index, so fetching an
+    old page costs the same as fetching the newest one. Ordered by the
+    channel sequence, not by id: ids come from per-worker blocks and do
+    not follow send order across workers. Archived messages
+    in the same range are merged in (see ``services.archive``), so pages
+    cross from the hot table into the archive seamlessly. The second value
+    is the cursor for the next (older) page, or None when there is none.
+    """
+    limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+    # Authors and reply parents come back in the same SELECT
+    query = db.query(Message).join(Message.user).options(
+        contains_eager(Message.user),
+        joinedload(Message.parent_message).joinedload(Message.user),
+    ).filter(Message.channel == channel)
+    if before_seq is not None:
+        query = query.filter(Message.seq < before_seq)
+    # One extra row tells us whether an older page exists
+    rows = query.order_by(Message.seq.desc()).limit(limit + 1).all()
+    messages = [format_message(msg) for msg in rows]
+
+    # Only archived messages newer than the oldest hot one can change the page;
+    # with nothing archived in that range this is a single index probe
+    after_seq = rows[-1].seq if len(rows) > limit else None
+    archived = fetch_archived(db, channel, before_seq=before_seq, after_seq=after_seq, limit=limit + 1)
+    if archived:
+        messages = sorted(messages + archived, key=lambda m: m["seq"], reverse=True)[:limit + 1]
+
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    messages.reverse()
+
+    next_before = messages[0]["seq"] if has_more and messages else None
+    return messages, next_before
+
+
+def message_event(msg: Message) -> dict:
+    """Protocol-neutral chat event for a stored message, as broadcast live"""
+    event = format_message(msg)
+    del event["timestamp"]
+    event.update(
+        type="message",
+        ts=epoch_ms(msg.timestamp),
+        parent_message_id=msg.parent_message_id,
+    )
+    event.setdefault("parent_message", None)
+    return event
+
+
+def fetch_since(db: Session, channel: str, after_seq: int, limit: int = MAX_REPLAY_MESSAGES) -> List[dict]:
+    """Message events with ``seq`` above ``after_seq``, oldest first.
+
+    A range over the (channel, seq) index; used when a reconnecting
+    client's gap is no longer in the in-memory replay buffer.
+    """
+    rows = db.query(Message).join(Message.user).options(
+        contains_eager(Message.user),
+        joinedload(Message.parent_message).joinedload(Message.user),
+    ).filter(
+        Message.channel == channel,
+        Message.seq > after_seq
+    ).order_by(Message.seq).limit(limit).all()
+    return [message_event(msg) for msg in rows]
@@ -0,0 +1,224 @@
+"""Recent chat messages kept in memory for reconnecting clients and page renders"""
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from services.chat_protocol import TIMESTAMP_FORMAT, from_epoch_ms
+
+# Messages remembered per channel for replay after a reconnect
+REPLAY_BUFFER_SIZE = int(os.getenv("REPLAY_BUFFER_SIZE", "500"))
+
+
+class ReplayBuffer:
+    """Bounded ring of recent message events per channel, ordered by ``seq``.
+
+    Filled from the broadcast stream, so it only covers channels this
+    worker is subscribed to; ``discard`` drops a channel's ring when the
+    subscription ends, since anything published afterwards never reaches it.
+    """
+
+    def __init__(self, size: int = REPLAY_BUFFER_SIZE):
+        self.size = size
+        self._rings: Dict[str, Deque[dict]] = {}
+
+    def append(self, channel: str, event: dict):
+        ring = self._rings.get(channel)
+        if ring is None:
+            ring = self._rings[channel] = deque(maxlen=self.size)
+        seq = event["seq"]
+        if not ring or ring[-1]["seq"] < seq:
+            ring.append(event)
+            return
+        # Workers publish concurrently, so a lower seq can arrive late
+        for i in range(len(ring) - 1, -1, -1):
+            if ring[i]["seq"] == seq:
+                return
+            if ring[i]["seq"] < seq:
+                ring.insert(i + 1, event)
+                break
+        else:
+            ring.appendleft(event)
+        if len(ring) > self.size:
+            ring.popleft()
+
+    def since(self, channel: str, last_seq: int) -> Optional[List[dict]]:
+        """Events after ``last_seq``, or None if the ring cannot vouch for the whole gap"""
+        ring = self._rings.get(channel)
+        if not ring or ring[0]["seq"] > last_seq + 1:
+            return None
+        events = []
+        expected = last_seq + 1
+        for event in ring:
+            if event["seq"] <= last_seq:
+                continue
+            if event["seq"] != expected:
+                return None
+            events.append(event)
+            expected += 1
+        return events
+
+    def latest_seq(self, channel: str) -> Optional[int]:
+        ring = self._rings.get(channel)
+        return ring[-1]["seq"] if ring else None
+
+    def discard(self, channel: str):
+        self._rings.pop(channel, None)
+
+
+# Messages per channel kept ready for page renders (the first history page)
+MESSAGE_CACHE_PAGE_SIZE = int(os.getenv("MESSAGE_CACHE_PAGE_SIZE", "50"))
+# Rough memory budget for all cached pages together
+MESSAGE_CACHE_MAX_BYTES = int(os.getenv("MESSAGE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# Seconds a page is trusted before it is reloaded; bounds staleness from
+# messages published by other workers while this one was not subscribed
+MESSAGE_CACHE_TTL = float(os.getenv("MESSAGE_CACHE_TTL", "30"))
+
+# Per-message overhead of the dicts and strings, on top of the text itself
+_MESSAGE_OVERHEAD = 400
+
+
+def _message_size(message: dict) -> int:
+    size = _MESSAGE_OVERHEAD + len(message.get("content") or "") + len(message.get("username") or "")
+    parent = message.get("parent_message")
+    if parent:
+        size += _MESSAGE_OVERHEAD + len(parent.get("content") or "")
+    return size
+
+
+def history_entry(event: dict) -> dict:
+    """A broadcast message event in the shape ``format_message`` gives stored ones"""
+    entry = {
+        "id": event["id"],
+        "seq": event.get("seq"),
+        "content": event["content"],
+        "username": event["username"],
+        "timestamp": from_epoch_ms(event["ts"]).strftime(TIMESTAMP_FORMAT),
+        "reply_count": 0,
+    }
+    if event.get("parent_message"):
+        entry["parent_message"] = event["parent_message"]
+    return entry
+
+
+class _CachedPage:
+    def __init__(self, messages: List[dict], next_before: Optional[int], expires: float):
+        self.messages = messages
+        self.next_before = next_before
+        self.expires = expires
+        self.size = sum(_message_size(m) for m in messages)
+
+
+class RecentMessages:
+    """The newest formatted messages of hot channels, shared by every viewer.
+
+    Holds what ``fetch_history`` returns for a channel's first page and
+    keeps it current by appending live messages. Pages are viewer
+    independent; callers add ``is_own`` to copies. Least recently used
+    channels are evicted once the total size passes ``max_bytes``.
+
+    A load is bracketed by ``begin_load`` / ``finish_load`` so messages
+    appended while the database read is in flight are merged, not lost.
+    """
+
+    def __init__(
+        self,
+        page_size: int = MESSAGE_CACHE_PAGE_SIZE,
+        max_bytes: int = MESSAGE_CACHE_MAX_BYTES,
+        ttl: float = MESSAGE_CACHE_TTL,
+    ):
+        self.page_size = page_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._pages: "OrderedDict[str, _CachedPage]" = OrderedDict()
+        self._loading: Dict[str, List[dict]] = {}
+
+    def get(self, channel: str) -> Optional[Tuple[List[dict], Optional[int]]]:
+        page = self._pages.get(channel)
+        if page is None or page.expires <= time.monotonic():
+            if page is not None:
+                self._drop(channel)
+            self.misses += 1
+            return None
+        self._pages.move_to_end(channel)
+        self.hits += 1
+        return page.messages, page.next_before
+
+    def begin_load(self, channel: str):
+        self._loading.setdefault(channel, [])
+
+    def finish_load(
+        self, channel: str, messages: List[dict], next_before: Optional[int], unstored: List[dict] = ()
+    ) -> Tuple[List[dict], Optional[int]]:
+        """Store a freshly read page plus anything appended during the read.
+
+        ``unstored`` are messages not committed yet when the page was read.
+        """
+        new = list(unstored) + self._loading.pop(channel, [])
+        current = self._pages.get(channel)
+        if current is not None:
+            # A concurrent load finished first and may have taken appends since
+            new = current.messages + new
+        messages, next_before = self._merge(messages, new, next_before)
+        self._drop(channel)
+        page = self._pages[channel] = _CachedPage(messages, next_before, time.monotonic() + self.ttl)
+        self.size += page.size
+        self._evict()
+        return page.messages, page.next_before
+
+    def abort_load(self, channel: str):
+        self._loading.pop(channel, None)
+
+    def append(self, channel: str, message: dict):
+        """Add a new message in history format to the channel's page, if cached"""
+        loading = self._loading.get(channel)
+        if loading is not None:
+            loading.append(message)
+        page = self._pages.get(channel)
+        if page is None:
+            return
+        is_new = all(m["id"] != message["id"] for m in page.messages)
+        messages, next_before = self._merge(page.messages, [message], page.next_before)
+        parent = message.get("parent_message")
+        if parent and is_new:
+            # Keep the parent's reply count current, on a copy since renders share the dict
+            messages = [
+                dict(m, reply_count=m.get("reply_count", 0) + 1) if m["id"] == parent["id"] else m
+                for m in messages
+            ]
+        # Pages are shared with renders in progress, so replace rather than mutate
+        self.size -= page.size
+        page.messages, page.next_before = messages, next_before
+        page.size = sum(_message_size(m) for m in messages)
+        self.size += page.size
+        self._evict()
+
+    def discard(self, channel: str):
+        self._drop(channel)
+
+    def _merge(self, messages: List[dict], new: List[dict], next_before: Optional[int]):
+        if not new:
+            return messages, next_before
+        by_id = {m["id"]: m for m in messages}
+        for m in new:
+            by_id.setdefault(m["id"], m)
+        # Nearly always in order already, which makes the sort linear
+        merged = sorted(by_id.values(), key=lambda m: m["seq"])
+        if len(merged) > self.page_size:
+            merged = merged[-self.page_size:]
+            # The older messages that fell off are reachable through the cursor
+            next_before = merged[0]["seq"]
+        return merged, next_before
+
+    def _drop(self, channel: str):
+        page = self._pages.pop(channel, None)
+        if page is not None:
+            self.size -= page.size
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self._pages) > 1:
+            _, page = self._pages.popitem(last=False)
+            self.size -= page.size
@@ -0,0 +1,261 @@
+"""Write-behind persistence for chat messages"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, update
+from sqlalchemy.exc import IntegrityError
+
+from models import IdAllocation, Message, MessageSegment
+from services.broadcast import BroadcastBackend, InProcessBackend
+from services.channel_directory import record_activity
+from services.db_executor import run_db, session_scope
+from services.metrics import MESSAGE_COMMIT_SECONDS
+from services.threads import record_replies
+
+# "async" broadcasts before the row is committed; "sync" waits for the
+# group commit that contains the message before broadcasting it
+MESSAGE_DURABILITY = os.getenv("MESSAGE_DURABILITY", "async")
+# A batch is committed once it holds this many messages...
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "200"))
+# ...or once its first message has waited this many seconds
+MESSAGE_BATCH_WINDOW = float(os.getenv("MESSAGE_BATCH_WINDOW", "0.05"))
+# Message ids reserved from the database per round trip
+MESSAGE_ID_BLOCK_SIZE = int(os.getenv("MESSAGE_ID_BLOCK_SIZE", "100"))
+
+DURABILITY_ASYNC = "async"
+DURABILITY_SYNC = "sync"
+
+# Largest value an INTEGER / BIGINT id column can hold
+MAX_MESSAGE_ID = 2 ** 63 - 1
+
+
+def valid_parent_id(value) -> bool:
+    """True for None or an int that can be stored as a parent_message_id"""
+    return value is None or (type(value) is int and 0 < value <= MAX_MESSAGE_ID)
+
+
+class IdAllocator:
+    """Hands out primary keys from blocks reserved in ``id_allocations``.
+
+    Reserving a block is a single atomic UPDATE, so several workers can
+    allocate ids for the same table without colliding.
+    """
+
+    def __init__(self, model, block_size: int = MESSAGE_ID_BLOCK_SIZE):
+        self.model = model
+        self.name = model.__tablename__
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+        self._lock = asyncio.Lock()
+
+    def _reserve_block(self) -> int:
+        with session_scope() as db:
+            for _ in range(3):
+                result = db.execute(
+                    update(IdAllocation)
+                    .where(IdAllocation.name == self.name)
+                    .values(next_value=IdAllocation.next_value + self.block_size)
+                )
+                if result.rowcount:
+                    end = db.query(IdAllocation.next_value).filter(
+                        IdAllocation.name == self.name
+                    ).scalar()
+                    db.commit()
+                    return end - self.block_size
+                # First use: continue after the ids already in the table
+                start = (db.query(func.max(self.model.id)).scalar() or 0) + 1
+                db.add(IdAllocation(name=self.name, next_value=start))
+                try:
+                    db.commit()
+                except IntegrityError:
+                    db.rollback()
+            raise RuntimeError(f"Could not reserve ids for {self.name}")
+
+    async def next_id(self) -> int:
+        async with self._lock:
+            if self._next >= self._end:
+                start = await run_db(self._reserve_block)
+                self._next, self._end = start, start + self.block_size
+            value = self._next
+            self._next += 1
+            return value
+
+
+class ChannelSequences:
+    """Per-channel message sequence numbers, allocated through the broadcast backend.
+
+    The first allocation for a channel in this process seeds the shared
+    counter from the highest ``seq`` already stored, hot or archived, so
+    numbering carries on across restarts.
+    """
+
+    def __init__(self, backend: Optional[BroadcastBackend] = None):
+        self.backend = backend or InProcessBackend()
+        self._seeded: Dict[str, int] = {}
+        self._lock = asyncio.Lock()
+
+    def _stored_max(self, channel: str) -> int:
+        with session_scope() as db:
+            hot = db.query(func.max(Message.seq)).filter(Message.channel == channel).scalar()
+            # The newest messages may all be archived already
+            archived = db.query(func.max(MessageSegment.last_seq)).filter(
+                MessageSegment.channel == channel
+            ).scalar()
+            return max(hot or 0, archived or 0)
+
+    async def next_seq(self, channel: str) -> int:
+        if channel not in self._seeded:
+            async with self._lock:
+                if channel not in self._seeded:
+                    self._seeded[channel] = await run_db(self._stored_max, channel)
+        # Only the first call passes the floor; the counter is past it afterwards
+        floor, self._seeded[channel] = self._seeded[channel], 0
+        return await self.backend.next_sequence(channel, floor)
+
+
+class MessageWriter:
+    """Queues chat messages and group-commits them in batches.
+
+    ``submit`` returns the message row, with its id, channel sequence
+    number and timestamp already assigned, plus a future resolved once
+    the row is committed. Rows that are not committed yet stay visible
+    through ``pending`` so replies to them can still be resolved. ``stop`` flushes everything still queued.
+
+    Broadcast a submitted message without awaiting anything else first
+    (other than its commit), or local subscribers see seqs out of order.
+    """
+
+    def __init__(
+        self,
+        durability: str = MESSAGE_DURABILITY,
+        batch_size: int = MESSAGE_BATCH_SIZE,
+        batch_window: float = MESSAGE_BATCH_WINDOW,
+        id_block_size: int = MESSAGE_ID_BLOCK_SIZE,
+        sequences: Optional[ChannelSequences] = None,
+    ):
+        if durability not in (DURABILITY_ASYNC, DURABILITY_SYNC):
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.durability = durability
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.ids = IdAllocator(Message, id_block_size)
+        self.sequences = sequences or ChannelSequences()
+        self.pending: Dict[int, dict] = {}
+        self._queue: List[Tuple[dict, asyncio.Future]] = []
+        self._has_items = asyncio.Event()
+        self._flush_now = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    async def start(self):
+        if self._task is not None:
+            return
+        self._stopping = False
+        # One thread keeps batches committing in order
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="message-writer")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._stopping = True
+        self._has_items.set()
+        self._flush_now.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def submit(self, **fields) -> Tuple[dict, asyncio.Future]:
+        # A bad value here would fail the whole batch it lands in
+        if not valid_parent_id(fields.get("parent_message_id")):
+            raise ValueError(f"Invalid parent_message_id: {fields['parent_message_id']!r}")
+        row = dict(fields)
+        row["id"] = await self.ids.next_id()
+        row["seq"] = await self.sequences.next_seq(row["channel"])
+        row["timestamp"] = datetime.utcnow()
+        committed = asyncio.get_running_loop().create_future()
+        self.pending[row["id"]] = row
+        self._queue.append((row, committed))
+        self._has_items.set()
+        if len(self._queue) >= self.batch_size:
+            self._flush_now.set()
+        return row, committed
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                if self._stopping:
+                    return
+                self._has_items.clear()
+                await self._has_items.wait()
+                continue
+            if len(self._queue) < self.batch_size and not self._stopping:
+                self._flush_now.clear()
+                try:
+                    await asyncio.wait_for(self._flush_now.wait(), self.batch_window)
+                except asyncio.TimeoutError:
+                    pass
+            batch = self._queue[:self.batch_size]
+            del self._queue[:self.batch_size]
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[dict, asyncio.Future]]):
+        rows = [row for row, _ in batch]
+        loop = asyncio.get_running_loop()
+        try:
+            failed = await loop.run_in_executor(self._executor, self._commit, rows)
+        except Exception as e:
+            failed = {row["id"]: e for row in rows}
+        if failed:
+            print(f"Dropped {len(failed)} chat message(s): {next(iter(failed.values()))}")
+        for row, committed in batch:
+            self.pending.pop(row["id"], None)
+            if committed.done():
+                continue
+            error = failed.get(row["id"])
+            # In async mode nobody waits on the future; the message is already out
+            if error is None or self.durability == DURABILITY_ASYNC:
+                committed.set_result(row["id"] if error is None else None)
+            else:
+                committed.set_exception(error)
+
+    def _commit(self, rows: List[dict]) -> Dict[int, Exception]:
+        """Commit ``rows`` in one transaction; returns ids that could not be stored"""
+        started = time.perf_counter()
+        try:
+            return self._commit_rows(rows)
+        finally:
+            MESSAGE_COMMIT_SECONDS.observe(time.perf_counter() - started)
+
+    def _commit_rows(self, rows: List[dict]) -> Dict[int, Exception]:
+        with session_scope() as db:
+            try:
+                db.add_all([Message(**row) for row in rows])
+                record_activity(db, rows)
+                record_replies(db, rows)
+                db.commit()
+                return {}
+            except Exception as e:
+                # Not only database errors: the driver raises e.g. OverflowError while binding
+                db.rollback()
+                print(f"Message batch commit failed, retrying one by one: {e}")
+
+            # Isolate the offending rows so one bad message doesn't lose the batch
+            failed = {}
+            for row in rows:
+                try:
+                    db.add(Message(**row))
+                    record_activity(db, [row])
+                    record_replies(db, [row])
+                    db.commit()
+                except Exception as e:
+                    db.rollback()
+                    failed[row["id"]] = e
+            return failed
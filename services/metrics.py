@@ -0,0 +1,272 @@
+"""Prometheus metrics for the chat, HTTP and database hot paths.
+
+A small in-process registry rendered in the Prometheus text format by
+``GET /metrics``. Updating a metric is a dict lookup plus an uncontended
+lock, cheap enough to leave on under full load; values that already live
+elsewhere (sockets per channel, queue depths) are read only when scraped.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event
+
+# When set, /metrics requires "Authorization: Bearer <token>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+_metrics: List["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames and type(self)._new_child is not _Metric._new_child:
+            # Unlabelled metrics report zero before their first update
+            self.labels()
+        _metrics.append(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def samples(self) -> Iterable[Tuple[str, Tuple[str, ...], Tuple[str, ...], float]]:
+        """(name suffix, label names, label values, value) for every sample"""
+        raise NotImplementedError
+
+
+class _CounterValue:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield "_total", self.labelnames, values, child.value
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "_lock")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # Per bucket, not cumulative; the last slot counts values above every bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self):
+        names = self.labelnames + ("le",)
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", names, values + (_format_value(float(bound)),), cumulative
+            yield "_sum", self.labelnames, values, total
+            yield "_count", self.labelnames, values, cumulative
+
+
+class GaugeFunction(_Metric):
+    """A gauge whose samples are computed by ``collect`` at scrape time.
+
+    ``collect`` returns (label values, value) pairs.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (),
+                 collect: Optional[Callable[[], Iterable[Tuple[Tuple[str, ...], float]]]] = None):
+        super().__init__(name, help, labelnames)
+        self.collect = collect
+
+    def samples(self):
+        if self.collect is None:
+            return
+        for values, value in self.collect():
+            yield "", self.labelnames, tuple(values), value
+
+
+def render() -> str:
+    """Every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        try:
+            for suffix, names, values, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(names, values)} {_format_value(value)}")
+        except Exception as e:
+            print(f"Collecting metric {metric.name} failed: {e}")
+    return "\n".join(lines) + "\n"
+
+
+# Chat
+WEBSOCKET_MESSAGES_RECEIVED = Counter(
+    "chat_messages_received", "Chat messages received from WebSocket clients")
+WEBSOCKET_FRAMES_SENT = Counter(
+    "chat_frames_sent", "Frames written to WebSocket clients")
+WEBSOCKET_FRAMES_DROPPED = Counter(
+    "chat_frames_dropped", "Frames dropped by the slow consumer policy")
+WEBSOCKET_FRAMES_REJECTED = Counter(
+    "chat_frames_rejected", "Client frames refused before processing", ("reason",))
+WEBSOCKET_FLOOD_CLOSES = Counter(
+    "chat_flood_closes", "Sockets closed for sending too many refused frames")
+WEBSOCKET_ERRORS = Counter(
+    "chat_websocket_errors", "WebSocket handlers that ended with an unexpected exception")
+FANOUT_SECONDS = Histogram(
+    "chat_fanout_seconds", "Time to encode and queue one published event for a channel's sockets")
+MESSAGE_COMMIT_SECONDS = Histogram(
+    "chat_message_commit_seconds", "Duration of one group commit of chat messages")
+
+# HTTP
+HTTP_REQUESTS = Counter(
+    "http_requests", "HTTP requests served", ("method", "route", "status"))
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_seconds", "HTTP request latency", ("method", "route"))
+HTTP_REQUEST_QUERIES = Histogram(
+    "http_request_queries", "SQL statements issued per HTTP request", ("method", "route"), COUNT_BUCKETS)
+
+# Database and auth
+DB_QUERIES = Counter("db_queries", "SQL statements sent to the database")
+PASSWORD_HASH_SECONDS = Histogram(
+    "password_hash_seconds", "Time spent in bcrypt per hash or verify", ("operation",))
+
+# Statement counter of the HTTP request being served, if any. Context
+# variables follow the request into run_db and threadpool calls.
+_request_queries: ContextVar[Optional[List[int]]] = ContextVar("request_queries", default=None)
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    DB_QUERIES.inc()
+    queries = _request_queries.get()
+    if queries is not None:
+        queries[0] += 1
+
+
+def instrument_engine(engine):
+    """Count every statement ``engine`` executes"""
+    if not event.contains(engine, "before_cursor_execute", _count_query):
+        event.listen(engine, "before_cursor_execute", _count_query)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, status and SQL statements per HTTP route.
+
+    Routes are labelled by their path template (``/c/{channel_name}``),
+    never the raw path, so label values stay bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._paths: Dict[object, str] = {}
+
+    def _route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        path = self._paths.get(endpoint)
+        if path is None:
+            for route in scope["app"].routes:
+                if getattr(route, "endpoint", None) is endpoint:
+                    path = route.path
+                    break
+            else:
+                path = "unmatched"
+            self._paths[endpoint] = path
+        return path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        queries = [0]
+        token = _request_queries.set(queries)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            _request_queries.reset(token)
+            method, route = scope["method"], self._route(scope)
+            HTTP_REQUESTS.labels(method, route, str(status[0])).inc()
+            HTTP_REQUEST_SECONDS.labels(method, route).observe(elapsed)
+            HTTP_REQUEST_QUERIES.labels(method, route).observe(queries[0])
@@ -0,0 +1,257 @@
+"""Versioned schema migrations.
+
+Each migration runs once per database, in order, and is recorded in
+``schema_migrations`` in the same transaction. That transaction holds an
+exclusive lock (``BEGIN IMMEDIATE`` on SQLite, an advisory lock on
+PostgreSQL), so workers starting together apply each migration once.
+Steps are still written to be idempotent (they check before they change
+anything) because databases created before this module existed already
+have some of the schema.
+
+    python -m services.migrations          # apply pending migrations
+    python -m services.migrations status   # list applied and pending ones
+"""
+import json
+import sys
+import zlib
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+
+from models import Base, CommentVote, PollVote, PostVote
+from services.search import create_search_indexes
+
+schema_migrations = Table(
+    "schema_migrations", MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+# Key of the PostgreSQL advisory lock taken while migrating
+MIGRATION_LOCK_KEY = 5_318_008
+
+
+def create_missing_tables(connection: Connection):
+    # New tables come with their indexes; indexes added to existing tables come later
+    Base.metadata.create_all(bind=connection, checkfirst=True)
+
+
+def add_message_seq(connection: Connection):
+    if "seq" not in {column["name"] for column in inspect(connection).get_columns("messages")}:
+        connection.execute(text("ALTER TABLE messages ADD COLUMN seq INTEGER"))
+
+
+def _dedupe(connection: Connection, table: str, columns: Tuple[str, ...]):
+    """Keep the earliest row of each group of duplicates"""
+    cols = ", ".join(columns)
+    result = connection.execute(text(
+        f"DELETE FROM {table} WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY {cols})"
+    ))
+    if result.rowcount:
+        print(f"Removed {result.rowcount} duplicate row(s) from {table}")
+
+
+def dedupe_votes(connection: Connection):
+    # The unique vote indexes created next would fail on existing duplicates
+    _dedupe(connection, PostVote.__tablename__, ("post_id", "user_id"))
+    _dedupe(connection, CommentVote.__tablename__, ("comment_id", "user_id"))
+    _dedupe(connection, PollVote.__tablename__, ("user_id", "option_id"))
+
+
+def create_declared_indexes(connection: Connection):
+    """Create the models' indexes, skipping ones on columns a later migration adds"""
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            if all(column.name in existing for column in index.columns):
+                index.create(bind=connection, checkfirst=True)
+
+
+def add_search_indexes(connection: Connection):
+    create_search_indexes(connection)
+
+
+def add_reply_counts(connection: Connection):
+    if "reply_count" not in {column["name"] for column in inspect(connection).get_columns("messages")}:
+        connection.execute(text("ALTER TABLE messages ADD COLUMN reply_count INTEGER NOT NULL DEFAULT 0"))
+    # Recount from scratch, so a rerun after a partial failure is still exact
+    connection.execute(text(
+        "UPDATE messages SET reply_count = (SELECT COUNT(*) FROM messages AS r "
+        "WHERE r.parent_message_id = messages.id) "
+        "WHERE id IN (SELECT parent_message_id FROM messages WHERE parent_message_id IS NOT NULL)"
+    ))
+
+
+_HOT_MESSAGE_COUNT = "(SELECT COUNT(*) FROM messages WHERE messages.user_id = users.id)"
+
+
+def _recount_users(connection: Connection, message_count: str):
+    # Plain SQL rather than services.user_counters, which follows the current schema
+    connection.execute(text(
+        f"UPDATE users SET message_count = {message_count}, "
+        "post_count = (SELECT COUNT(*) FROM forum_posts WHERE forum_posts.author_id = users.id), "
+        "comment_count = (SELECT COUNT(*) FROM forum_comments WHERE forum_comments.author_id = users.id)"
+    ))
+    connection.execute(text(
+        "UPDATE users SET total_interactions = message_count + post_count + comment_count"
+    ))
+
+
+def add_user_counters(connection: Connection):
+    existing = {column["name"] for column in inspect(connection).get_columns("users")}
+    for column in ("message_count", "post_count", "comment_count", "total_interactions"):
+        if column not in existing:
+            connection.execute(text(f"ALTER TABLE users ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0"))
+    _recount_users(connection, _HOT_MESSAGE_COUNT)
+    create_declared_indexes(connection)
+
+
+def add_message_archive(connection: Connection):
+    create_missing_tables(connection)
+    create_declared_indexes(connection)
+    # From now on message_count includes archived messages
+    _recount_users(connection, _HOT_MESSAGE_COUNT + " + COALESCE((SELECT message_count "
+                   "FROM archived_message_counts WHERE archived_message_counts.user_id = users.id), 0)")
+
+
+def order_history_by_seq(connection: Connection):
+    """Give every message, hot or archived, a channel seq; history pages by seq from now on"""
+    existing = {column["name"] for column in inspect(connection).get_columns("message_segments")}
+    for column in ("first_seq", "last_seq"):
+        if column not in existing:
+            connection.execute(text(f"ALTER TABLE message_segments ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0"))
+
+    segments = {
+        row.id: (row.channel, json.loads(zlib.decompress(row.data)))
+        for row in connection.execute(text("SELECT id, channel, data FROM message_segments"))
+    }
+    # Messages from before seq existed are older than every numbered one; in id
+    # order (a single writer back then) they take the seqs up to and including 0
+    legacy = defaultdict(list)
+    for row in connection.execute(text("SELECT id, channel FROM messages WHERE seq IS NULL")):
+        legacy[row.channel].append(row.id)
+    for channel, records in segments.values():
+        legacy[channel].extend(record["id"] for record in records if record["seq"] is None)
+    numbered = {}
+    for ids in legacy.values():
+        ids.sort()
+        numbered.update((message_id, position - len(ids)) for position, message_id in enumerate(ids, 1))
+    if numbered:
+        connection.execute(
+            text("UPDATE messages SET seq = :seq WHERE id = :id AND seq IS NULL"),
+            [{"id": message_id, "seq": seq} for message_id, seq in numbered.items()],
+        )
+
+    for segment_id, (channel, records) in segments.items():
+        for record in records:
+            if record["seq"] is None:
+                record["seq"] = numbered[record["id"]]
+        records.sort(key=lambda record: record["seq"])
+        connection.execute(
+            text("UPDATE message_segments SET first_seq = :first, last_seq = :last, data = :data WHERE id = :id"),
+            {"id": segment_id, "first": records[0]["seq"], "last": records[-1]["seq"],
+             "data": zlib.compress(json.dumps(records, separators=(",", ":")).encode())},
+        )
+
+    connection.execute(text("DROP INDEX IF EXISTS ix_message_segments_channel_last_id"))
+    create_declared_indexes(connection)
+
+
+def add_poll_vote_versions(connection: Connection):
+    if "vote_version" not in {column["name"] for column in inspect(connection).get_columns("polls")}:
+        connection.execute(text("ALTER TABLE polls ADD COLUMN vote_version INTEGER NOT NULL DEFAULT 0"))
+
+
+def drop_message_channel_id_index(connection: Connection):
+    # History pages by (channel, seq) now; the (channel, id) index only cost writes
+    connection.execute(text("DROP INDEX IF EXISTS ix_messages_channel_id"))
+
+
+# (version, name, step). Append new migrations; never edit or reorder applied ones.
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "create missing tables", create_missing_tables),
+    (2, "message sequence numbers", add_message_seq),
+    (3, "remove duplicate votes", dedupe_votes),
+    (4, "hot path and unique vote indexes", create_declared_indexes),
+    (5, "full-text search indexes", add_search_indexes),
+    (6, "message reply counts", add_reply_counts),
+    (7, "user activity counters", add_user_counters),
+    (8, "message archive", add_message_archive),
+    (9, "history ordered by channel seq", order_history_by_seq),
+    (10, "poll vote versions", add_poll_vote_versions),
+    (11, "drop unused messages (channel, id) index", drop_message_channel_id_index),
+]
+
+
+def applied_versions(engine: Engine) -> set:
+    with engine.connect() as connection:
+        if not inspect(connection).has_table(schema_migrations.name):
+            return set()
+        return {row[0] for row in connection.execute(schema_migrations.select())}
+
+
+def _lock(connection: Connection):
+    """Begin a transaction that no other migrating process can enter until it ends"""
+    if connection.dialect.name == "sqlite":
+        # Takes the write lock now; the busy timeout makes other processes wait for it
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+    elif connection.dialect.name == "postgresql":
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+
+
+def run_migrations(engine: Engine) -> List[str]:
+    """Apply pending migrations; returns the names of the ones applied"""
+    # Checked without the lock first, so a migrated database starts without waiting
+    applied = applied_versions(engine)
+    ran = []
+    for version, name, step in MIGRATIONS:
+        if version in applied:
+            continue
+        with engine.connect() as connection:
+            _lock(connection)
+            schema_migrations.create(bind=connection, checkfirst=True)
+            # Another worker may have applied it while we waited for the lock
+            if connection.execute(select(schema_migrations.c.version).where(
+                schema_migrations.c.version == version
+            )).first():
+                continue
+            step(connection)
+            try:
+                connection.execute(schema_migrations.insert().values(
+                    version=version, name=name, applied_at=datetime.utcnow()
+                ))
+            except IntegrityError:
+                # Only possible on databases without a migration lock; the step is idempotent
+                connection.rollback()
+                continue
+            connection.commit()
+        print(f"Applied migration {version}: {name}")
+        ran.append(name)
+    return ran
+
+
+def main():
+    from database import engine
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "upgrade"
+    if command == "upgrade":
+        ran = run_migrations(engine)
+        print(f"{len(ran)} migration(s) applied")
+    elif command == "status":
+        applied = applied_versions(engine)
+        for version, name, _ in MIGRATIONS:
+            print(f"{'applied' if version in applied else 'pending':>8}  {version:>3}  {name}")
+    else:
+        sys.exit(f"Unknown command: {command} (expected upgrade or status)")
+
+
+if __name__ == "__main__":
+    main()
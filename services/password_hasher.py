@@ -0,0 +1,108 @@
+"""Password hashing on a bounded worker pool instead of the event loop"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+from services.metrics import PASSWORD_HASH_SECONDS
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# bcrypt runs with the GIL released, so threads give real parallelism
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 2)))
+# Requests allowed to wait for a worker before new ones are turned away
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+
+
+class PasswordHasherBusy(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=503, detail="Too many sign-in attempts, please retry shortly")
+
+
+class PasswordHasher:
+    """Runs bcrypt hash/verify on a dedicated pool with a bounded queue.
+
+    At most ``workers`` hashes run at once; up to ``max_pending`` more
+    wait their turn and anything beyond that fails fast with a 503, so a
+    login storm queues here instead of stalling the event loop.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        # Queueing metrics
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.run_seconds_total = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+            self._slots = asyncio.Semaphore(self.workers)
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._slots = None
+
+    async def _run(self, operation: str, fn, *args):
+        executor = self._pool()
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordHasherBusy()
+
+        queued_at = time.perf_counter()
+        self.pending += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.pending -= 1
+        started_at = time.perf_counter()
+        wait = started_at - queued_at
+        self.wait_seconds_total += wait
+        self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+        self.running += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, fn, *args)
+        finally:
+            self.running -= 1
+            self.completed += 1
+            elapsed = time.perf_counter() - started_at
+            self.run_seconds_total += elapsed
+            PASSWORD_HASH_SECONDS.labels(operation).observe(elapsed)
+            self._slots.release()
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", pwd_context.hash, password)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._run("verify", pwd_context.verify, password, hashed)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "running": self.running,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "wait_seconds_total": self.wait_seconds_total,
+            "run_seconds_total": self.run_seconds_total,
+            "max_wait_seconds": self.max_wait_seconds,
+        }
+
+
+password_hasher = PasswordHasher()
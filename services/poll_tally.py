@@ -0,0 +1,126 @@
+"""In-memory poll tallies updated by vote deltas"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from models import Poll, PollOption, PollVote
+
+# Polls kept in memory, and seconds before a tally is re-read from the
+# database (picks up votes recorded by other workers)
+POLL_TALLY_SIZE = int(os.getenv("POLL_TALLY_SIZE", "1000"))
+POLL_TALLY_TTL = float(os.getenv("POLL_TALLY_TTL", "30"))
+
+
+class PollTally:
+    """option id -> vote count per poll, loaded once and then kept current.
+
+    Every vote bumps its poll's ``vote_version`` in the vote's own
+    transaction, and a tally remembers the version it reflects. A delta
+    is added only if it is the next version; older ones are already
+    counted, and a gap (a delta this worker never received) drops the
+    tally so the next vote reloads it. Votes committed by other workers
+    arrive through ``apply_remote``.
+    """
+
+    def __init__(self, maxsize: int = POLL_TALLY_SIZE, ttl: float = POLL_TALLY_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # poll id -> (expires at, vote_version, counts)
+        self._tallies: "OrderedDict[int, Tuple[float, int, Dict[int, int]]]" = OrderedDict()
+        self._locks: Dict[int, threading.Lock] = {}
+        self._guard = threading.Lock()
+
+    def lock(self, poll_id: int) -> threading.Lock:
+        with self._guard:
+            lock = self._locks.get(poll_id)
+            if lock is None:
+                lock = self._locks[poll_id] = threading.Lock()
+            return lock
+
+    def _load(self, db: Session, poll_id: int) -> Tuple[int, Dict[int, int]]:
+        # One statement, so the counts and the version come from the same snapshot
+        rows = db.query(Poll.vote_version, PollOption.id, func.count(PollVote.id)).join(
+            PollOption, PollOption.poll_id == Poll.id
+        ).outerjoin(
+            PollVote, PollVote.option_id == PollOption.id
+        ).filter(
+            Poll.id == poll_id
+        ).group_by(Poll.vote_version, PollOption.id).all()
+        version = rows[0][0] if rows else 0
+        return version, {option_id: count for _, option_id, count in rows}
+
+    def _cached(self, poll_id: int) -> Optional[Tuple[float, int, Dict[int, int]]]:
+        """The live entry for ``poll_id``; call with ``_guard`` held"""
+        entry = self._tallies.get(poll_id)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry
+
+    def counts(self, db: Session, poll_id: int) -> Dict[int, int]:
+        """Current counts for ``poll_id``; call with ``lock(poll_id)`` held"""
+        with self._guard:
+            entry = self._cached(poll_id)
+            if entry is not None:
+                self._tallies.move_to_end(poll_id)
+                return entry[2]
+
+        version, counts = self._load(db, poll_id)
+        with self._guard:
+            self._tallies[poll_id] = (time.monotonic() + self.ttl, version, counts)
+            while len(self._tallies) > self.maxsize:
+                self._tallies.popitem(last=False)
+        return counts
+
+    def _add(self, poll_id: int, entry, deltas: Dict, version: int):
+        """Apply ``deltas`` of ``version`` to ``entry``; call with ``_guard`` held"""
+        expires_at, _, counts = entry
+        for option_id, delta in deltas.items():
+            option_id = int(option_id)
+            counts[option_id] = counts.get(option_id, 0) + delta
+        self._tallies[poll_id] = (expires_at, version, counts)
+
+    def apply(self, db: Session, poll_id: int, deltas: Dict[int, int], version: int) -> Dict[int, int]:
+        """Add the deltas of a committed vote that produced ``version``; call with ``lock(poll_id)`` held.
+
+        A tally that is not in memory, or missed an earlier version, is
+        reloaded from the database, which already includes this vote.
+        """
+        with self._guard:
+            entry = self._cached(poll_id)
+            if entry is not None and entry[1] == version - 1:
+                self._add(poll_id, entry, deltas, version)
+                # A copy: apply_remote may change the tally while the caller reads it
+                return dict(entry[2])
+            if entry is not None and entry[1] >= version:
+                return dict(entry[2])
+            self._tallies.pop(poll_id, None)
+        return dict(self.counts(db, poll_id))
+
+    def apply_remote(self, poll_id: int, deltas: Dict, version: int):
+        """Add deltas of a vote another worker committed, if the poll is in memory.
+
+        Does not wait for the poll's lock, so it is safe on the event loop.
+        An uncached poll is skipped: its next load reads the vote from the
+        database. Keys may be strings after a JSON round trip.
+        """
+        with self._guard:
+            entry = self._cached(poll_id)
+            if entry is None or version <= entry[1]:
+                return
+            if version == entry[1] + 1:
+                self._add(poll_id, entry, deltas, version)
+            else:
+                # Missed a delta, e.g. while not subscribed to the channel
+                self._tallies.pop(poll_id, None)
+
+    def invalidate(self, poll_id: int):
+        with self._guard:
+            self._tallies.pop(poll_id, None)
+
+
+poll_tally = PollTally()
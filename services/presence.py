@@ -0,0 +1,301 @@
+"""Who is online in each chat channel, plus typing indicators"""
+import asyncio
+import os
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from services.cm import ConnectionManager
+
+# Seconds between presence events per channel; joins, leaves and typing
+# notifications inside one window go out together as a single event
+PRESENCE_FLUSH_INTERVAL = float(os.getenv("PRESENCE_FLUSH_INTERVAL", "1.0"))
+# Minimum seconds between two typing notifications from the same user in a channel
+TYPING_MIN_INTERVAL = float(os.getenv("TYPING_MIN_INTERVAL", "3.0"))
+# Seconds between full membership snapshots from each worker; a worker
+# not heard from for three intervals is assumed gone with its members
+PRESENCE_SYNC_INTERVAL = float(os.getenv("PRESENCE_SYNC_INTERVAL", "30"))
+# Most usernames returned by the presence API
+PRESENCE_LIST_LIMIT = 100
+
+# Backend channel carrying membership changes between workers; chat
+# channel names come from a single URL path segment, so none contains "/"
+MEMBERSHIP_CHANNEL = "presence/members"
+
+
+class ChannelPresence:
+    def __init__(self):
+        # user id -> this worker's open sockets, so several tabs count as one member
+        self.members: Dict[int, int] = {}
+        # user id -> workers the user is connected to, this one included
+        self.workers: Dict[int, int] = {}
+        self.usernames: Dict[int, str] = {}
+        # Changes since the last flush
+        self.joined: Set[int] = set()
+        self.left: Dict[int, str] = {}
+        self.typing: Set[int] = set()
+
+
+class RemoteWorker:
+    def __init__(self):
+        self.seen = time.monotonic()
+        # channel -> user id -> username, as last published by that worker
+        self.channels: Dict[str, Dict[int, str]] = {}
+
+
+class PresenceTracker:
+    """Per-channel membership with O(1) join/leave and batched fan-out.
+
+    Join, leave and typing only update counters and mark the channel
+    dirty. A flush task then sends at most one presence event per dirty
+    channel per interval, so a burst of N joins in a room of N members
+    costs N deliveries instead of N^2. Nothing here touches the database.
+
+    With a shared backend every worker publishes its membership changes,
+    tagged with its worker id, plus a periodic full snapshot, and counts
+    a user online while any worker has them. Each worker derives the same
+    joins and leaves from that and delivers them to its own sockets.
+    Typing indicators are about a single user and are broadcast as is.
+    """
+
+    def __init__(
+        self,
+        manager: ConnectionManager,
+        flush_interval: float = PRESENCE_FLUSH_INTERVAL,
+        typing_interval: float = TYPING_MIN_INTERVAL,
+        sync_interval: float = PRESENCE_SYNC_INTERVAL,
+    ):
+        self.manager = manager
+        self.flush_interval = flush_interval
+        self.typing_interval = typing_interval
+        self.sync_interval = sync_interval
+        self.channels: Dict[str, ChannelPresence] = {}
+        self.remote: Dict[str, RemoteWorker] = {}
+        self._dirty: Set[str] = set()
+        self._last_typing: Dict[Tuple[str, int], float] = {}
+        # channel -> user id -> username on a local join, None on a local leave
+        self._outbox: Dict[str, Dict[int, Optional[str]]] = {}
+        self._next_snapshot = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def shared(self) -> bool:
+        return self.manager.backend.shared
+
+    async def start(self):
+        if self._task is not None:
+            return
+        if self.shared:
+            await self.manager.listen(MEMBERSHIP_CHANNEL, self.receive)
+            # Ask the other workers for their members along with ours
+            await self._publish_snapshot(hello=True)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            if self.shared:
+                try:
+                    await self._publish({"type": "presence_snapshot", "members": {}, "gone": True})
+                except Exception as e:
+                    print(f"Presence goodbye failed: {e}")
+
+    def _channel(self, channel: str) -> ChannelPresence:
+        presence = self.channels.get(channel)
+        if presence is None:
+            presence = self.channels[channel] = ChannelPresence()
+        return presence
+
+    def _arrive(self, channel: str, user_id: int, username: str):
+        presence = self._channel(channel)
+        workers = presence.workers.get(user_id, 0)
+        presence.workers[user_id] = workers + 1
+        if workers:
+            return
+        presence.usernames[user_id] = username
+        # A leave and re-join inside one window cancel out
+        if presence.left.pop(user_id, None) is None:
+            presence.joined.add(user_id)
+        self._dirty.add(channel)
+
+    def _depart(self, channel: str, user_id: int):
+        presence = self.channels.get(channel)
+        if presence is None or user_id not in presence.workers:
+            return
+        workers = presence.workers[user_id] - 1
+        if workers > 0:
+            presence.workers[user_id] = workers
+            return
+        del presence.workers[user_id]
+        username = presence.usernames.pop(user_id, None)
+        presence.typing.discard(user_id)
+        if user_id in presence.joined:
+            presence.joined.discard(user_id)
+        else:
+            presence.left[user_id] = username
+        self._dirty.add(channel)
+
+    def join(self, channel: str, user_id: int, username: str):
+        presence = self._channel(channel)
+        tabs = presence.members.get(user_id, 0)
+        presence.members[user_id] = tabs + 1
+        if tabs == 0:
+            self._arrive(channel, user_id, username)
+            if self.shared:
+                self._outbox.setdefault(channel, {})[user_id] = username
+
+    def leave(self, channel: str, user_id: int):
+        presence = self.channels.get(channel)
+        if presence is None or user_id not in presence.members:
+            return
+        tabs = presence.members[user_id] - 1
+        if tabs > 0:
+            presence.members[user_id] = tabs
+            return
+        del presence.members[user_id]
+        self._last_typing.pop((channel, user_id), None)
+        self._depart(channel, user_id)
+        if self.shared:
+            self._outbox.setdefault(channel, {})[user_id] = None
+
+    def typing(self, channel: str, user_id: int) -> bool:
+        """Record a typing notification; returns False if it was rate-limited"""
+        presence = self.channels.get(channel)
+        if presence is None or user_id not in presence.members:
+            return False
+        now = time.monotonic()
+        key = (channel, user_id)
+        if now - self._last_typing.get(key, float("-inf")) < self.typing_interval:
+            return False
+        self._last_typing[key] = now
+        presence.typing.add(user_id)
+        self._dirty.add(channel)
+        return True
+
+    def online_count(self, channel: str) -> int:
+        presence = self.channels.get(channel)
+        return len(presence.workers) if presence else 0
+
+    def online_users(self, channel: str, limit: int = PRESENCE_LIST_LIMIT) -> List[str]:
+        presence = self.channels.get(channel)
+        if presence is None:
+            return []
+        names = []
+        for user_id in presence.workers:
+            if len(names) >= limit:
+                break
+            names.append(presence.usernames[user_id])
+        return names
+
+    def receive(self, message: dict):
+        """Apply membership published by another worker"""
+        origin = message.get("origin")
+        if origin is None or origin == self.manager.worker_id:
+            return
+        data = message["data"]
+        if data.get("gone"):
+            self._drop_worker(origin)
+            return
+        worker = self.remote.get(origin)
+        if worker is None:
+            worker = self.remote[origin] = RemoteWorker()
+        worker.seen = time.monotonic()
+        if data["type"] == "presence_delta":
+            for channel, changes in data["changes"].items():
+                members = worker.channels.setdefault(channel, {})
+                for user_id, username in changes:
+                    if username is None:
+                        if members.pop(user_id, None) is not None:
+                            self._depart(channel, user_id)
+                    elif user_id not in members:
+                        members[user_id] = username
+                        self._arrive(channel, user_id, username)
+                if not members:
+                    del worker.channels[channel]
+        elif data["type"] == "presence_snapshot":
+            members = {channel: dict(users) for channel, users in data["members"].items()}
+            self._replace(worker, members)
+            if data.get("hello"):
+                # A worker just started; let it hear from us soon
+                self._next_snapshot = 0.0
+
+    def _replace(self, worker: RemoteWorker, channels: Dict[str, Dict[int, str]]):
+        old = worker.channels
+        worker.channels = channels
+        for channel in set(old) | set(channels):
+            before, after = old.get(channel, {}), channels.get(channel, {})
+            for user_id in before.keys() - after.keys():
+                self._depart(channel, user_id)
+            for user_id in after.keys() - before.keys():
+                self._arrive(channel, user_id, after[user_id])
+
+    def _drop_worker(self, worker_id: str):
+        worker = self.remote.pop(worker_id, None)
+        if worker is not None:
+            self._replace(worker, {})
+
+    async def _publish(self, data: dict):
+        await self.manager.broadcast(MEMBERSHIP_CHANNEL, data)
+
+    async def _publish_snapshot(self, hello: bool = False):
+        self._next_snapshot = time.monotonic() + self.sync_interval
+        members = {
+            channel: [[user_id, presence.usernames[user_id]] for user_id in presence.members]
+            for channel, presence in self.channels.items() if presence.members
+        }
+        # The snapshot already holds everything waiting to go out
+        self._outbox.clear()
+        await self._publish({"type": "presence_snapshot", "members": members, "hello": hello})
+
+    async def _sync(self):
+        """Publish this worker's membership changes; forget workers that went quiet"""
+        now = time.monotonic()
+        if now >= self._next_snapshot:
+            await self._publish_snapshot()
+        elif self._outbox:
+            outbox, self._outbox = self._outbox, {}
+            changes = {channel: list(users.items()) for channel, users in outbox.items()}
+            await self._publish({"type": "presence_delta", "changes": changes})
+        for worker_id in [w for w, worker in self.remote.items() if now - worker.seen > 3 * self.sync_interval]:
+            self._drop_worker(worker_id)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Presence flush failed: {e}")
+
+    async def flush(self):
+        if self.shared:
+            await self._sync()
+        dirty, self._dirty = self._dirty, set()
+        for channel in dirty:
+            presence = self.channels.get(channel)
+            if presence is None:
+                continue
+            membership = None
+            if presence.joined or presence.left:
+                membership = {
+                    "type": "presence",
+                    "joined": [presence.usernames[u] for u in presence.joined if u in presence.usernames],
+                    "left": [name for name in presence.left.values() if name],
+                    "typing": [],
+                    "online_count": len(presence.workers),
+                }
+            typing = [presence.usernames[u] for u in presence.typing if u in presence.usernames]
+            presence.joined.clear()
+            presence.left.clear()
+            presence.typing.clear()
+            if not presence.workers:
+                del self.channels[channel]
+            if membership is not None:
+                # Every worker derives the same event from the shared membership
+                self.manager.deliver(channel, {"data": membership})
+            if typing:
+                await self.manager.broadcast(channel, {"type": "presence", "joined": [], "left": [], "typing": typing})
@@ -0,0 +1,148 @@
+"""Check that the hot-path queries are served by indexes.
+
+Runs the real query functions against a scratch SQLite database built
+by the migrations, captures every statement they issue and asks SQLite
+for its plan. A plan that reads a whole table (``SCAN <table>`` without
+an index) is reported and the command exits non-zero, so a dropped or
+unusable index shows up before it shows up in latency.
+
+    python -m services.query_plans
+"""
+import os
+import sys
+import tempfile
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import Session, sessionmaker
+
+from models import (
+    User, Message, ForumPost, ForumComment, PostVote, CommentVote,
+    Poll, PollOption, PollVote, Channel,
+)
+from services.migrations import run_migrations
+
+
+def _seed(db: Session):
+    user = User(username="plan", password="x")
+    db.add(user)
+    db.flush()
+    parent = Message(content="hello", channel="general", user_id=user.id, seq=1)
+    db.add(parent)
+    db.flush()
+    db.add(Message(content="reply", channel="general", user_id=user.id, seq=2, parent_message_id=parent.id))
+    post = ForumPost(title="Post", content="body", author_id=user.id)
+    db.add(post)
+    db.flush()
+    comment = ForumComment(content="comment", author_id=user.id, post_id=post.id)
+    db.add(comment)
+    db.flush()
+    db.add_all([
+        PostVote(post_id=post.id, user_id=user.id, vote_type="up"),
+        CommentVote(comment_id=comment.id, user_id=user.id, vote_type="up"),
+    ])
+    poll = Poll(title="Poll", channel="general", creator_id=user.id)
+    db.add(poll)
+    db.flush()
+    option = PollOption(text="yes", poll_id=poll.id)
+    db.add(option)
+    db.flush()
+    db.add(PollVote(user_id=user.id, option_id=option.id))
+    db.add(Channel(name="general", message_count=2))
+    db.commit()
+    return user, post, poll
+
+
+def hot_paths(db: Session) -> List[Tuple[str, Callable[[], object]]]:
+    from services.history import fetch_history, fetch_since
+    from services.poll_service import format_polls, get_user_votes
+    from services.poll_tally import PollTally
+    from services.channel_directory import ChannelDirectory
+    from services.search import SearchIndex
+    from services.threads import fetch_thread
+    from services.user_counters import top_users
+    from services.archive import _archivable
+
+    user, post, poll = _seed(db)
+    search = SearchIndex()
+    search.detect(db.get_bind())
+    return [
+        ("channel history page", lambda: fetch_history(db, "general")),
+        ("older history page", lambda: fetch_history(db, "general", before_seq=2)),
+        ("replay since seq", lambda: fetch_since(db, "general", 0)),
+        ("reply thread", lambda: fetch_thread(db, "general", 1)),
+        ("channel polls", lambda: format_polls(db, "general", user)),
+        ("viewer poll votes", lambda: get_user_votes(db, user, [poll.id])),
+        ("poll tally", lambda: PollTally()._load(db, poll.id)),
+        ("channel directory", lambda: ChannelDirectory().list_channels(db, limit=10)),
+        ("post with vote tallies", lambda: db.query(ForumPost).filter(ForumPost.id == post.id).all()),
+        ("post comments", lambda: db.query(ForumComment).filter(
+            ForumComment.post_id == post.id).order_by(ForumComment.created_at).all()),
+        ("top users", lambda: top_users(db)),
+        ("archive candidates", lambda: _archivable(db, "general", datetime.utcnow(), 10)),
+        ("user by name", lambda: db.query(User).filter(User.username == "plan").first()),
+        ("message search", lambda: search.search_messages(db, "hello", channel="general")),
+    ]
+
+
+def full_scans(plan: List[str]) -> List[str]:
+    """Plan steps that read every row of a table"""
+    return [
+        step for step in plan
+        if step.startswith("SCAN ") and " USING " not in step and "VIRTUAL TABLE" not in step
+        and not step.startswith("SCAN CONSTANT ROW")
+    ]
+
+
+def check(engine) -> List[Tuple[str, str, List[str]]]:
+    """Returns (path, statement, offending plan steps) for every full scan"""
+    statements: List[Tuple[str, object]] = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    failures = []
+    db = sessionmaker(bind=engine)()
+    try:
+        paths = hot_paths(db)
+        for name, run in paths:
+            statements.clear()
+            event.listen(engine, "before_cursor_execute", capture)
+            try:
+                run()
+            finally:
+                event.remove(engine, "before_cursor_execute", capture)
+            with engine.connect() as connection:
+                for statement, parameters in list(statements):
+                    plan = [row[-1] for row in connection.exec_driver_sql(
+                        "EXPLAIN QUERY PLAN " + statement, parameters
+                    )]
+                    scans = full_scans(plan)
+                    if scans:
+                        failures.append((name, statement, scans))
+    finally:
+        db.close()
+    return failures
+
+
+def main():
+    path = os.path.join(tempfile.mkdtemp(prefix="query_plans_"), "plans.db")
+    engine = create_engine(f"sqlite:///{path}")
+    try:
+        run_migrations(engine)
+        failures = check(engine)
+    finally:
+        engine.dispose()
+        os.remove(path)
+
+    for name, statement, scans in failures:
+        print(f"FULL SCAN in {name}: {'; '.join(scans)}\n    {' '.join(statement.split())[:300]}")
+    if failures:
+        sys.exit(1)
+    print("All hot-path queries use indexes")
+
+
+if __name__ == "__main__":
+    main()
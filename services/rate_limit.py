@@ -0,0 +1,107 @@
+"""Flood control for WebSocket ingest: token buckets per user and per channel"""
+import os
+import time
+from typing import Dict, Hashable, Optional, Tuple
+
+# Sustained chat frames per second a user may send (all their sockets together)...
+USER_MESSAGE_RATE = float(os.getenv("USER_MESSAGE_RATE", "5"))
+# ...and how many they may send at once after being idle
+USER_MESSAGE_BURST = float(os.getenv("USER_MESSAGE_BURST", "10"))
+# Sustained frames per second accepted into one channel from all its users
+CHANNEL_MESSAGE_RATE = float(os.getenv("CHANNEL_MESSAGE_RATE", "100"))
+CHANNEL_MESSAGE_BURST = float(os.getenv("CHANNEL_MESSAGE_BURST", "200"))
+# Largest frame accepted from a client, in characters (text) or bytes (binary)
+MAX_FRAME_SIZE = int(os.getenv("WS_MAX_FRAME_SIZE", str(16 * 1024)))
+# Consecutive rejected frames after which the socket is closed
+MAX_REJECTED_FRAMES = int(os.getenv("WS_MAX_REJECTED_FRAMES", "50"))
+
+# Reasons a frame is refused, also used as metric labels
+USER_RATE = "user_rate"
+CHANNEL_RATE = "channel_rate"
+FRAME_TOO_LARGE = "frame_too_large"
+
+
+class TokenBucket:
+    """Token buckets for any number of keys, refilled lazily on use.
+
+    A key holds at most ``burst`` tokens and gains ``rate`` per second; a
+    key missing from the table has a full bucket. Buckets that have
+    refilled completely are dropped from time to time, so idle users and
+    channels take no memory.
+    """
+
+    def __init__(self, rate: float, burst: float, prune_every: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.prune_every = prune_every
+        # key -> (tokens, monotonic time they were counted)
+        self._buckets: Dict[Hashable, Tuple[float, float]] = {}
+        self._calls = 0
+
+    def take(self, key: Hashable, now: Optional[float] = None) -> float:
+        """Take one token for ``key``; returns 0 on success, else seconds until one is available"""
+        if now is None:
+            now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens, counted = bucket
+            tokens = min(self.burst, tokens + (now - counted) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self._buckets[key] = (tokens - 1, now)
+        self._calls += 1
+        if self._calls >= self.prune_every:
+            self._prune(now)
+        return 0.0
+
+    def refund(self, key: Hashable):
+        """Give back a token taken for a frame that was refused elsewhere"""
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            self._buckets[key] = (min(self.burst, bucket[0] + 1), bucket[1])
+
+    def _prune(self, now: float):
+        self._calls = 0
+        full_after = self.burst / self.rate
+        self._buckets = {
+            key: bucket for key, bucket in self._buckets.items()
+            if now - bucket[1] < full_after
+        }
+
+
+class IngestLimiter:
+    """Decides whether a frame from a user in a channel may be processed.
+
+    Checked before a frame is decoded, so a refused frame costs two dict
+    lookups and never reaches the database or the broadcast.
+    """
+
+    def __init__(
+        self,
+        user_rate: float = USER_MESSAGE_RATE,
+        user_burst: float = USER_MESSAGE_BURST,
+        channel_rate: float = CHANNEL_MESSAGE_RATE,
+        channel_burst: float = CHANNEL_MESSAGE_BURST,
+        max_frame_size: int = MAX_FRAME_SIZE,
+    ):
+        self.users = TokenBucket(user_rate, user_burst)
+        self.channels = TokenBucket(channel_rate, channel_burst)
+        self.max_frame_size = max_frame_size
+
+    def check(self, user_id: int, channel: str, frame_size: int) -> Tuple[Optional[str], float]:
+        """(None, 0) if the frame may go through, else (reason, seconds to wait before retrying)"""
+        if frame_size > self.max_frame_size:
+            return FRAME_TOO_LARGE, 0.0
+        now = time.monotonic()
+        wait = self.users.take(user_id, now)
+        if wait:
+            return USER_RATE, wait
+        wait = self.channels.take(channel, now)
+        if wait:
+            # The channel is saturated; the user's own allowance is not spent
+            self.users.refund(user_id)
+            return CHANNEL_RATE, wait
+        return None, 0.0
@@ -0,0 +1,235 @@
+"""Full-text search over chat messages and forum posts"""
+import re
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+# Terms used from a query; the rest are ignored
+MAX_QUERY_TERMS = 16
+# Characters of post content returned with each post hit
+POST_EXCERPT_LENGTH = 300
+
+# FTS5 index -> (indexed table, indexed columns, bm25 column weights).
+# The indexes are external-content: they hold only tokens and read the
+# text back from the table itself, so they add no second copy of it.
+FTS_INDEXES = {
+    "messages_fts": ("messages", ("content",), (1.0,)),
+    # A hit in the title counts for more than one in the body
+    "forum_posts_fts": ("forum_posts", ("title", "content"), (5.0, 1.0)),
+}
+
+
+def _index_ddl(index: str, table: str, columns: Tuple[str, ...], weights: Tuple[float, ...]) -> List[str]:
+    cols = ", ".join(columns)
+    new = ", ".join(f"new.{c}" for c in columns)
+    old = ", ".join(f"old.{c}" for c in columns)
+    delete = f"INSERT INTO {index}({index}, rowid, {cols}) VALUES ('delete', old.id, {old});"
+    insert = f"INSERT INTO {index}(rowid, {cols}) VALUES (new.id, {new});"
+    return [
+        f"CREATE VIRTUAL TABLE {index} USING fts5({cols}, content='{table}', "
+        f"content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        f"INSERT INTO {index}({index}, rank) VALUES ('rank', 'bm25({', '.join(map(str, weights))})')",
+        # Triggers keep the index current on every insert, update and delete
+        f"CREATE TRIGGER IF NOT EXISTS {index}_ai AFTER INSERT ON {table} BEGIN {insert} END",
+        f"CREATE TRIGGER IF NOT EXISTS {index}_ad AFTER DELETE ON {table} BEGIN {delete} END",
+        f"CREATE TRIGGER IF NOT EXISTS {index}_au AFTER UPDATE OF {cols} ON {table} "
+        f"BEGIN {delete} {insert} END",
+        # Index whatever the table already holds
+        f"INSERT INTO {index}({index}) VALUES ('rebuild')",
+    ]
+
+
+def create_search_indexes(connection) -> bool:
+    """Create and backfill missing FTS indexes and their triggers.
+
+    Run from the migrations. Returns False when the database has no FTS5,
+    in which case searches use the LIKE fallback.
+    """
+    if connection.dialect.name != "sqlite":
+        return False
+    existing = {row[0] for row in connection.execute(text(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"
+    ))}
+    try:
+        for index, (table, columns, weights) in FTS_INDEXES.items():
+            if index not in existing:
+                for statement in _index_ddl(index, table, columns, weights):
+                    connection.execute(text(statement))
+    except OperationalError as e:
+        print(f"Full-text search unavailable, falling back to LIKE scans: {e}")
+        return False
+    return True
+
+
+def build_match_query(query: str) -> Optional[str]:
+    """FTS5 MATCH expression for free text: every term must match, the last as a prefix.
+
+    Terms are quoted, so operators and punctuation typed by users can
+    never make the expression invalid.
+    """
+    terms = re.findall(r"\w+", query)[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def encode_cursor(rank: float, row_id: int) -> str:
+    return f"{rank!r}:{row_id}"
+
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    try:
+        rank, row_id = cursor.split(":")
+        return float(rank), int(row_id)
+    except ValueError:
+        raise ValueError("Invalid search cursor")
+
+
+class SearchIndex:
+    """Ranked, filterable, keyset-paginated search.
+
+    Uses SQLite FTS5 when the database supports it. Otherwise ``available``
+    stays False and searches fall back to a LIKE scan, newest first, which
+    is correct but reads every row.
+    """
+
+    def __init__(self):
+        self.available = False
+
+    def detect(self, engine: Engine) -> bool:
+        """Use the FTS indexes if the migrations could create them"""
+        with engine.connect() as connection:
+            existing = {row[0] for row in connection.execute(text(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            ))} if engine.dialect.name == "sqlite" else set()
+        self.available = all(index in existing for index in FTS_INDEXES)
+        return self.available
+
+    def _page(self, rows, limit: int) -> Tuple[list, Optional[str]]:
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].rank, rows[-1].id) if has_more and rows else None
+        return rows, next_cursor
+
+    def _keyset(self, rank_expr: str, id_expr: str, cursor: Optional[str], params: dict) -> str:
+        # Best rank first (bm25 is lower for better hits), newest first among ties
+        if cursor is None:
+            return ""
+        params["cursor_rank"], params["cursor_id"] = decode_cursor(cursor)
+        return (f" AND ({rank_expr} > :cursor_rank OR "
+                f"({rank_expr} = :cursor_rank AND {id_expr} < :cursor_id))")
+
+    def search_messages(
+        self,
+        db: Session,
+        query: str,
+        channel: Optional[str] = None,
+        author: Optional[str] = None,
+        cursor: Optional[str] = None,
+        limit: int = SEARCH_PAGE_SIZE,
+    ) -> Tuple[List[dict], Optional[str]]:
+        """Chat messages matching ``query``; returns hits and the next page's cursor"""
+        match = build_match_query(query)
+        if match is None:
+            return [], None
+        limit = max(1, min(limit, MAX_SEARCH_PAGE_SIZE))
+        params = {"limit": limit + 1}
+
+        if self.available:
+            rank_expr = "messages_fts.rank"
+            sql = ("SELECT m.id, m.seq, m.channel, m.content, m.timestamp, u.username, "
+                   "messages_fts.rank AS rank FROM messages_fts "
+                   "JOIN messages m ON m.id = messages_fts.rowid "
+                   "JOIN users u ON u.id = m.user_id "
+                   "WHERE messages_fts MATCH :match")
+            params["match"] = match
+        else:
+            rank_expr = "0.0"
+            sql = ("SELECT m.id, m.seq, m.channel, m.content, m.timestamp, u.username, "
+                   "0.0 AS rank FROM messages m JOIN users u ON u.id = m.user_id "
+                   "WHERE m.content LIKE :like")
+            params["like"] = f"%{query.strip()}%"
+        if channel is not None:
+            sql += " AND m.channel = :channel"
+            params["channel"] = channel
+        if author is not None:
+            sql += " AND u.username = :author"
+            params["author"] = author
+        sql += self._keyset(rank_expr, "m.id", cursor, params)
+        sql += f" ORDER BY {rank_expr}, m.id DESC LIMIT :limit"
+
+        rows, next_cursor = self._page(db.execute(text(sql), params).all(), limit)
+        return [{
+            "id": row.id,
+            "seq": row.seq,
+            "channel": row.channel,
+            "username": row.username,
+            "content": row.content,
+            "timestamp": _format_timestamp(row.timestamp),
+            "rank": row.rank,
+        } for row in rows], next_cursor
+
+    def search_posts(
+        self,
+        db: Session,
+        query: str,
+        author: Optional[str] = None,
+        cursor: Optional[str] = None,
+        limit: int = SEARCH_PAGE_SIZE,
+    ) -> Tuple[List[dict], Optional[str]]:
+        """Forum posts whose title or content matches ``query``"""
+        match = build_match_query(query)
+        if match is None:
+            return [], None
+        limit = max(1, min(limit, MAX_SEARCH_PAGE_SIZE))
+        params = {"limit": limit + 1}
+
+        if self.available:
+            rank_expr = "forum_posts_fts.rank"
+            sql = ("SELECT p.id, p.title, p.content, p.tag, p.created_at, u.username, "
+                   "forum_posts_fts.rank AS rank FROM forum_posts_fts "
+                   "JOIN forum_posts p ON p.id = forum_posts_fts.rowid "
+                   "JOIN users u ON u.id = p.author_id "
+                   "WHERE forum_posts_fts MATCH :match")
+            params["match"] = match
+        else:
+            rank_expr = "0.0"
+            sql = ("SELECT p.id, p.title, p.content, p.tag, p.created_at, u.username, "
+                   "0.0 AS rank FROM forum_posts p JOIN users u ON u.id = p.author_id "
+                   "WHERE (p.title LIKE :like OR p.content LIKE :like)")
+            params["like"] = f"%{query.strip()}%"
+        if author is not None:
+            sql += " AND u.username = :author"
+            params["author"] = author
+        sql += self._keyset(rank_expr, "p.id", cursor, params)
+        sql += f" ORDER BY {rank_expr}, p.id DESC LIMIT :limit"
+
+        rows, next_cursor = self._page(db.execute(text(sql), params).all(), limit)
+        return [{
+            "id": row.id,
+            "title": row.title,
+            "excerpt": row.content[:POST_EXCERPT_LENGTH],
+            "tag": row.tag,
+            "username": row.username,
+            "created_at": _format_timestamp(row.created_at),
+            "rank": row.rank,
+        } for row in rows], next_cursor
+
+
+def _format_timestamp(value) -> Optional[str]:
+    # Raw SQL returns SQLite datetimes as text; keep the seconds-precision format used elsewhere
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value[:19]
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+search_index = SearchIndex()
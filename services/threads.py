@@ -0,0 +1,82 @@
+"""Reply threads: whole reply trees in one query, and maintained reply counts"""
+from collections import Counter
+from typing import List, Optional, Tuple
+
+from sqlalchemy import literal, select, update
+from sqlalchemy.orm import Session, aliased, contains_eager
+
+from models import Message
+from services.history import format_message
+
+# Reply levels returned below the root when the client does not ask for fewer
+THREAD_DEPTH = 5
+MAX_THREAD_DEPTH = 50
+# Messages returned per thread request, root included
+THREAD_PAGE_SIZE = 200
+MAX_THREAD_PAGE_SIZE = 1000
+
+
+def record_replies(db: Session, rows: List[dict]):
+    """Add a batch of new message rows to their parents' ``reply_count``.
+
+    Runs inside the caller's transaction, with one UPDATE per parent.
+    Replies from another channel are not counted; threads leave them out.
+    """
+    counts = Counter(
+        (row["parent_message_id"], row["channel"]) for row in rows if row.get("parent_message_id")
+    )
+    if not counts:
+        return
+    # A parent may be in this very batch; insert it before counting its replies
+    db.flush()
+    for (parent_id, channel), count in counts.items():
+        db.execute(update(Message).where(Message.id == parent_id, Message.channel == channel).values(
+            reply_count=Message.reply_count + count
+        ))
+
+
+def fetch_thread(
+    db: Session,
+    channel: str,
+    root_id: int,
+    depth: int = THREAD_DEPTH,
+    limit: int = THREAD_PAGE_SIZE,
+) -> Tuple[Optional[List[dict]], bool]:
+    """The reply tree under ``root_id``, down to ``depth`` levels, oldest first.
+
+    A single recursive query walks the parent_message_id index. Each
+    message carries its ``depth`` below the root and its ``reply_count``,
+    so a client can tell which branches continue past the depth limit
+    and fetch them as threads of their own. Returns (None, False) if the
+    root is not in ``channel``; the second value is True when the
+    thread had more than ``limit`` messages.
+    """
+    depth = max(0, min(depth, MAX_THREAD_DEPTH))
+    limit = max(1, min(limit, MAX_THREAD_PAGE_SIZE))
+
+    thread = select(Message.id, literal(0).label("depth")).where(
+        Message.id == root_id, Message.channel == channel
+    ).cte("thread", recursive=True)
+    reply = aliased(Message)
+    thread = thread.union_all(
+        select(reply.id, thread.c.depth + 1).where(
+            # Parents are not checked at ingest, so replies from other channels are cut off here
+            reply.parent_message_id == thread.c.id, reply.channel == channel, thread.c.depth < depth
+        )
+    )
+
+    rows = db.query(Message, thread.c.depth).join(thread, Message.id == thread.c.id).join(
+        Message.user
+    ).options(contains_eager(Message.user)).order_by(Message.seq).limit(limit + 1).all()
+    if not rows:
+        return None, False
+
+    has_more = len(rows) > limit
+    messages = []
+    for msg, level in rows[:limit]:
+        # Parents are part of the tree itself, so they are not repeated inline
+        message_data = format_message(msg, include_parent=False)
+        message_data["parent_message_id"] = msg.parent_message_id
+        message_data["depth"] = level
+        messages.append(message_data)
+    return messages, has_more
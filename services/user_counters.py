@@ -0,0 +1,70 @@
+"""Stored per-user activity counters: repair and leaderboard reads.
+
+``User.message_count``, ``post_count``, ``comment_count`` and
+``total_interactions`` are columns kept current by a Session
+``after_flush`` hook in ``models``, in the same transaction as the rows
+they count. Bulk ``query(...).delete()`` and raw SQL bypass the hook;
+``repair`` recounts from the tables when that has happened.
+
+    python -m services.user_counters           # recount and fix every user
+"""
+from typing import Dict, List
+
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import Session
+
+from models import ArchivedMessageCount, ForumComment, ForumPost, Message, User
+
+
+COUNTER_COLUMNS = ("message_count", "post_count", "comment_count", "total_interactions")
+
+
+def counters_for(db: Session, user_id: int) -> Dict[str, int]:
+    """One user's activity counters, in one query"""
+    row = db.query(*(getattr(User, column) for column in COUNTER_COLUMNS)).filter(User.id == user_id).one()
+    return dict(zip(COUNTER_COLUMNS, row))
+
+
+def _counts():
+    return {
+        # Archived messages still count; they are tallied when moved (services/archive.py)
+        "message_count": select(func.count(Message.id)).where(Message.user_id == User.id).scalar_subquery()
+        + func.coalesce(select(ArchivedMessageCount.message_count).where(
+            ArchivedMessageCount.user_id == User.id).scalar_subquery(), 0),
+        "post_count": select(func.count(ForumPost.id)).where(ForumPost.author_id == User.id).scalar_subquery(),
+        "comment_count": select(func.count(ForumComment.id)).where(ForumComment.author_id == User.id).scalar_subquery(),
+    }
+
+
+def repair(connection) -> int:
+    """Recount every user's counters from the tables; returns how many users were off"""
+    counts = _counts()
+    stale = connection.execute(update(User).where(
+        (User.message_count != counts["message_count"])
+        | (User.post_count != counts["post_count"])
+        | (User.comment_count != counts["comment_count"])
+    ).values(**counts))
+    # The total is derived from the counters just fixed
+    connection.execute(update(User).where(
+        User.total_interactions != User.message_count + User.post_count + User.comment_count
+    ).values(total_interactions=User.message_count + User.post_count + User.comment_count))
+    return stale.rowcount
+
+
+def top_users(db: Session, limit: int = 10) -> List[User]:
+    """Most active users first; reads only the top of ix_users_total_interactions"""
+    return db.query(User).order_by(
+        User.total_interactions.desc(), User.id.desc()
+    ).limit(limit).all()
+
+
+def main():
+    from database import engine
+
+    with engine.begin() as connection:
+        fixed = repair(connection)
+    print(f"Repaired activity counters of {fixed} user(s)")
+
+
+if __name__ == "__main__":
+    main()
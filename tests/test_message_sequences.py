@@ -0,0 +1,57 @@
+"""Channel sequence numbers must carry on after a restart, even once the newest messages are archived"""
+import asyncio
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import Message, MessageSegment, User
+from services.archive import archive_channel
+from services.migrations import run_migrations
+
+# The writer opens its own sessions through the app's database module
+database = pytest.importorskip("database")
+
+
+@pytest.fixture
+def Session(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'chat.db'}", connect_args={"check_same_thread": False})
+    run_migrations(engine)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    monkeypatch.setattr(database, "SessionLocal", factory)
+    yield factory
+    engine.dispose()
+
+
+async def write(user_id: int, *contents: str):
+    """Commit ``contents`` through a fresh writer, as a newly started worker would"""
+    from services.message_writer import DURABILITY_SYNC, MessageWriter
+
+    writer = MessageWriter(durability=DURABILITY_SYNC, batch_window=0)
+    await writer.start()
+    try:
+        seqs = []
+        for content in contents:
+            message, committed = await writer.submit(content=content, user_id=user_id, channel="general")
+            await committed
+            seqs.append(message["seq"])
+        return seqs
+    finally:
+        await writer.stop()
+
+
+def test_sequence_continues_after_archive(Session):
+    with Session() as db:
+        user = User(username="alice", password="x")
+        db.add(user)
+        db.commit()
+        user_id = user.id
+
+    assert asyncio.run(write(user_id, "one", "two", "three")) == [1, 2, 3]
+
+    with Session() as db:
+        assert archive_channel(db, "general", older_than_days=0) == 3
+        assert db.query(Message).count() == 0
+        assert db.query(MessageSegment.last_seq).scalar() == 3
+
+    assert asyncio.run(write(user_id, "four")) == [4]
@@ -0,0 +1,88 @@
+"""Channel and poll pages must cost a fixed number of queries, whatever the data size"""
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from models import Message, Poll, PollOption, PollVote, User
+from services.history import fetch_history
+from services.migrations import run_migrations
+from services.poll_service import format_polls
+
+# Statements per call; a change here is a regression unless it is deliberate
+HISTORY_QUERIES = 2  # the page with authors and parents, plus the archive segment probe
+POLL_PAGE_QUERIES = 3  # polls with creators, options with vote counts, the viewer's votes
+
+
+@pytest.fixture
+def sessions(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'chat.db'}")
+    run_migrations(engine)
+    yield engine, sessionmaker(bind=engine)
+    engine.dispose()
+
+
+@contextmanager
+def count_queries(engine):
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+
+def seed(db, users: int, messages: int, polls: int, options: int):
+    """A channel with replies from several authors and polls voted on by every user"""
+    authors = [User(username=f"user{i}", password="x") for i in range(users)]
+    db.add_all(authors)
+    db.flush()
+    stored = []
+    for i in range(messages):
+        # Every third message replies to an earlier one, by another author
+        parent = stored[i // 2] if i % 3 == 2 else None
+        message = Message(
+            content=f"message {i}", channel="general", user_id=authors[i % users].id,
+            seq=i + 1, parent_message_id=parent.id if parent else None,
+        )
+        db.add(message)
+        db.flush()
+        stored.append(message)
+    for i in range(polls):
+        poll = Poll(title=f"poll {i}", channel="general", creator_id=authors[i % users].id)
+        db.add(poll)
+        db.flush()
+        choices = [PollOption(text=f"option {j}", poll_id=poll.id) for j in range(options)]
+        db.add_all(choices)
+        db.flush()
+        db.add_all(PollVote(user_id=author.id, option_id=choices[k % options].id) for k, author in enumerate(authors))
+    db.commit()
+    return authors[0]
+
+
+@pytest.mark.parametrize("users, messages, polls, options", [(2, 5, 1, 2), (20, 300, 15, 6)])
+def test_fixed_query_counts(sessions, users, messages, polls, options):
+    engine, Session = sessions
+    with Session() as db:
+        viewer = seed(db, users, messages, polls, options)
+        viewer_id = viewer.id
+
+    with Session() as db, count_queries(engine) as statements:
+        page, _ = fetch_history(db, "general")
+    assert len(page) == min(messages, 50)
+    assert any("parent_message" in m for m in page)
+    assert len(statements) == HISTORY_QUERIES, statements
+
+    with Session() as db:
+        viewer = db.get(User, viewer_id)
+        with count_queries(engine) as statements:
+            formatted = format_polls(db, "general", viewer)
+    assert len(formatted) == polls
+    assert all(poll["total_votes"] == users for poll in formatted)
+    assert all(poll["user_vote"] is not None for poll in formatted)
+    assert len(statements) == POLL_PAGE_QUERIES, statements
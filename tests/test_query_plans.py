@@ -0,0 +1,14 @@
+"""Hot-path queries must be served by indexes on a fully migrated database"""
+from sqlalchemy import create_engine
+
+from services.migrations import run_migrations
+from services.query_plans import check
+
+
+def test_hot_paths_use_indexes(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'plans.db'}")
+    try:
+        run_migrations(engine)
+        assert check(engine) == []
+    finally:
+        engine.dispose()